@@ -1,22 +1,69 @@
+import os
 import numpy
+import jax
 import jax.numpy as np
 from math import floor
 import time
+import json
+import copy
+import itertools
+import queue
+import threading
 from collections import deque
-from jax import jit, grad, vmap, value_and_grad
+from functools import partial, wraps
+from typing import NamedTuple
+from jax import jit, grad, vmap, value_and_grad, lax
 import jax.scipy.stats
 from jax.scipy.stats import multivariate_normal as jmvn
 from scipy.stats import multivariate_normal as mvn
-from jax.scipy.special import logsumexp as lse
+from jax.scipy.special import logsumexp as lse, entr
 from jax.scipy.linalg import solve_triangular
 from jax import nn, random
+from scipy.spatial import cKDTree
 from sklearn.cluster import KMeans
 
 
 epsilon = 1e-10
 
+def timed(metric):
+    ## Method decorator for the per-phase timers: with bw.timing on, appends the wall time (in seconds) of
+    ## each call to bw.<metric>. Dispatched device work is waited for before and after the call, so the time
+    ## is the cost of the phase itself and not whatever async dispatch left pending. Each timed call also
+    ## shows up as a named range in jax.profiler traces (see Bubblewrap.trace).
+    def wrap(f):
+        @wraps(f)
+        def timed_f(self, *args, **kwargs):
+            if not self.timing:
+                return f(self, *args, **kwargs)
+            with jax.profiler.TraceAnnotation(f.__name__):
+                self.sync()
+                start = time.perf_counter()
+                out = f(self, *args, **kwargs)
+                self.sync()
+                getattr(self, metric).append(time.perf_counter() - start)
+            return out
+        return timed_f
+    return wrap
+
+def enable_compilation_cache(path=None, min_compile_time=0):
+    ## Turn on JAX's persistent compilation cache: executables are written to path and later processes with
+    ## the same shapes, JAX version and backend load them instead of compiling again. Call it before the
+    ## first model runs. path defaults to $BUBBLEWRAP_CACHE, else ~/.cache/bubblewrap/jax; only kernels that
+    ## took at least min_compile_time seconds to compile are stored.
+    if path is None:
+        path = os.environ.get('BUBBLEWRAP_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'bubblewrap', 'jax'))
+    os.makedirs(path, exist_ok=True)
+    jax.config.update('jax_compilation_cache_dir', path)
+    jax.config.update('jax_persistent_cache_min_compile_time_secs', min_compile_time)
+    return path
+
 class Bubblewrap():
-    def __init__(self, num, dim, seed=42, M=30, step=1e-6, lam=1, eps=3e-2, nu=1e-2, B_thresh=1e-4, n_thresh=5e-4, t_wait=1, batch=False, batch_size=1, go_fast = False, future_distance=1):
+    def __init__(self, num, dim, seed=42, M=30, step=1e-6, lam=1, eps=3e-2, nu=1e-2, B_thresh=1e-4, n_thresh=5e-4, t_wait=1, batch=False, batch_size=1, go_fast = False, future_distance=1, transition_k=None, active_size=None, lazy_decay=False, packed=False, m_step='adam', m_step_every=1, m_step_period=None, metrics_maxlen=None, timing=False, dtype=None, bucket=None):
+        ## bucket: round the number of nodes up to a multiple of bucket, so models of nearby sizes have the
+        ## same shapes and share compiled kernels (the extra nodes are ordinary nodes)
+        self.bucket = bucket
+        if bucket is not None:
+            num = -(-num // bucket) * bucket
         self.N = num            # Number of nodes
         self.d = dim            # dimension of the space
         self.seed = seed
@@ -27,7 +74,7 @@ class Bubblewrap():
         self.B_thresh = B_thresh
         self.n_thresh = n_thresh
         self.t_wait = t_wait
-        self.step = step
+        self.step_size = step   # Adam step size
 
         self.batch = batch
         self.batch_size = batch_size
@@ -38,6 +85,54 @@ class Bubblewrap():
         self.go_fast = go_fast
         self.future_distance = future_distance
         self.future_x = None
+
+        ## keep only transition_k outgoing transitions per node (None: dense N x N transitions)
+        self.transition_k = transition_k
+
+        ## only score and update the active_size nodes most likely now or next (None: all nodes every step)
+        self.active_size = active_size
+
+        ## decay the rows of S1, S2 and En only when they are read or written (see lazy_update_internal)
+        self.lazy_decay = lazy_decay
+        if lazy_decay and active_size is None:
+            raise ValueError("lazy_decay needs an active_size; otherwise every row gets new mass on every step")
+
+        ## store S2 and L_lower (and its Adam moments) as packed lower triangles, d(d+1)/2 and d(d-1)/2 per node
+        self.packed = packed
+
+        ## float dtype of the model state: None is JAX's default, float32 unless jax_enable_x64 is set. Under
+        ## x64, dtype='float32' keeps the faster, half-size float32 state; the forward recursion is normalized
+        ## in log space (forward_alpha), so float32 doesn't underflow on long streams. The one-off host-side
+        ## factorizations in init_nodes run in float64 either way.
+        self.dtype = numpy.dtype(jax.dtypes.canonicalize_dtype(float) if dtype is None else dtype)
+        if self.dtype not in (numpy.float32, numpy.float64):
+            raise ValueError("dtype must be 'float32' or 'float64'")
+        if jax.dtypes.canonicalize_dtype(self.dtype) != self.dtype:
+            raise ValueError("dtype='float64' needs jax.config.update('jax_enable_x64', True)")
+
+        ## 'adam': gradient steps on Q_j; 'closed_form': jump to the maximizer of Q_j (NIW / Dirichlet MAP)
+        if m_step not in ('adam', 'closed_form'):
+            raise ValueError("m_step must be 'adam' or 'closed_form'")
+        self.m_step = m_step
+
+        ## M-step schedule: once every m_step_every samples, or (host-driven, in step and grad_Q) once at least
+        ## m_step_period seconds have passed since the last one; S1, S2, En and n_obs accumulate in between
+        self.m_step_every = m_step_every
+        self.m_step_period = m_step_period
+        self.last_m_step = time.perf_counter()
+        self.learner = None     # background M-step thread, see start_learner
+
+        ## keep only the most recent metrics_maxlen values of each tracked metric (None: all of them)
+        self.metrics_maxlen = metrics_maxlen
+
+        ## time observe, e_step, update_B, the predictions, grad_Q and step into the time_* metrics (see timed)
+        self.timing = timing
+        self.time_em = MetricBuffer(self.metrics_maxlen)
+        self.time_observe = MetricBuffer(self.metrics_maxlen)
+        self.time_updates = MetricBuffer(self.metrics_maxlen)
+        self.time_grad_Q = MetricBuffer(self.metrics_maxlen)
+        self.time_pred = MetricBuffer(self.metrics_maxlen)
+        self.time_step = MetricBuffer(self.metrics_maxlen)
         
         self.key = random.PRNGKey(self.seed)
         numpy.random.seed(self.seed)
@@ -45,15 +140,36 @@ class Bubblewrap():
         # observations of the data; M is how many to keep in history
         if self.batch: M=self.batch_size
         self.obs = Observations(self.d, M=M, go_fast=go_fast)
-        self.get_mus0 = jit(vmap(get_mus, 0))
+        self.get_mus0 = get_mus0
         self.mu_orig = None
         
-    def init_nodes(self):
+    def init_nodes(self, warm_start=None, decay=1, seeding='kmeans'):
         ### Based on observed data so far of length M
-        self.mu = np.zeros((self.N, self.d))
+        ## warm_start: a previous tiling to start from instead (see warm_start_nodes), whose evidence is
+        ## carried over scaled by decay
+        ## seeding: with at least N observations, place the nodes by sklearn 'kmeans' or by 'minibatch' k-means
+        ## on device (minibatch_kmeans), which scales to thousands of nodes
+        if seeding not in ('kmeans', 'minibatch'):
+            raise ValueError("seeding must be 'kmeans' or 'minibatch'")
+        ## everything is built with NumPy on the host and moved to the device at the end, rather than
+        ## compiling and dispatching a string of small JAX ops
+        self.mu = numpy.zeros((self.N, self.d))
 
         com = center_mass(self.mu)
-        if len(self.obs.saved_obs) >= self.N:
+        if warm_start is not None:
+            tiling = load_tiling(warm_start)
+            if tiling['mu'].shape[0] > self.N or tiling['mu'].shape[1] != self.d:
+                raise ValueError(f"a tiling of {tiling['mu'].shape[0]} nodes in {tiling['mu'].shape[1]} dimensions "
+                                 f"can't seed {self.N} nodes in {self.d}")
+            ## nodes beyond the saved ones start at its center of mass
+            weights = tiling['n_obs'] + 1e-16
+            obs_com = weights @ tiling['mu'] / numpy.sum(weights)
+            if len(self.obs.saved_obs) == 0:
+                self.obs.curr = obs_com
+        elif len(self.obs.saved_obs) >= self.N and seeding == 'minibatch':
+            print("initializing using mini-batch kmeans")
+            obs_com = numpy.asarray(minibatch_kmeans(random.fold_in(self.key, 1), np.asarray(self.obs.saved_obs), self.N))
+        elif len(self.obs.saved_obs) >= self.N:
             print("initializing using kmeans")
             km = KMeans(n_clusters=self.N,max_iter=50)
             km.fit(self.obs.saved_obs)
@@ -68,120 +184,230 @@ class Bubblewrap():
 
         self.mu += obs_com
 
-        prior = (1/self.N)*np.ones(self.N)
+        prior = (1/self.N)*numpy.ones(self.N)
 
         self.alpha = self.lam_0 * prior
         self.last_alpha = self.alpha.copy()
         self.lam = self.lam_0 * prior 
         self.n_obs = 0*self.alpha
+        self.touched = numpy.ones(self.N, dtype=int)     # step each row of S1, S2 and En was last decayed to (lazy_decay)
 
         self.mu_orig = self.mu.copy() 
         self.mus_orig = self.get_mus0(self.mu_orig) 
 
         ### Initialize model parameters (A,En,...)
-        self.A = np.ones((self.N,self.N)) - np.eye(self.N)
-        self.A /= np.sum(self.A, axis=1)
-        self.B = np.zeros((self.N))
-        self.En = np.zeros((self.N,self.N)) 
-
-        self.S1 = np.zeros((self.N,self.d))
-        self.S2 = np.zeros((self.N,self.d,self.d))
+        if self.transition_k is None:
+            self.A_idx = None
+            self.A = numpy.ones((self.N,self.N)) - numpy.eye(self.N)
+            self.A /= numpy.sum(self.A, axis=1)
+        else:
+            ## top-k transitions: A[i, j] is the probability of going from i to A_idx[i, j].
+            ## Start from the next k nodes in teleport order; observed transitions replace the weakest ones.
+            self.A_idx = (numpy.arange(self.N)[:,None] + numpy.arange(1, self.transition_k+1)[None,:]) % self.N
+            self.A = numpy.ones((self.N,self.transition_k)) / self.transition_k
+        self.B = numpy.zeros((self.N))
+        self.En = numpy.zeros_like(self.A)
+
+        self.S1 = numpy.zeros((self.N,self.d))
+        if self.packed:
+            self.S2 = numpy.zeros((self.N,self.d*(self.d+1)//2))
+        else:
+            self.S2 = numpy.zeros((self.N,self.d,self.d))
 
-        self.log_A = np.zeros((self.N,self.N))
+        self.log_A = numpy.zeros_like(self.A)
 
-        fullSigma = numpy.zeros((self.N,self.d,self.d), dtype="float32")
-        self.L = numpy.zeros((self.N,self.d,self.d))
-        self.L_diag = numpy.zeros((self.N,self.d))
-        if self.batch and not self.go_fast:
-            var = self.obs.cov
+        if self.batch and not self.go_fast and self.obs.n_obs > 2:
+            var = numpy.asarray(self.obs.cov)
+        elif warm_start is not None and len(self.obs.saved_obs) < 2:
+            ## no data yet: the spread of the saved tiling stands in for the data variance
+            var = numpy.diag(numpy.diag(mixture_cov(tiling['mu'], tiling['L'], tiling['n_obs'])))
         else:
-            var = np.diag(np.var(np.array(self.obs.saved_obs), axis=0))
-        for n in numpy.arange(self.N):
-            fullSigma[n] = var * (self.nu + self.d + 1) / (self.N**(2/self.d))
-            
-            ## Optimization is done with L split into L_lower and L_diag elements
-            ## L is defined using cholesky of precision matrix, NOT covariance
-            L = np.linalg.cholesky(fullSigma[n])
-            self.L[n] = np.linalg.inv(L).T
-            self.L_diag[n] = np.log(np.diag(self.L[n]))        
-        self.L_lower = np.tril(self.L,-1)        
-        self.sigma_orig = fullSigma[0] 
-
-        ## Set up gradients
-        ## Change grad to value_and_grad if we want Q values
-        self.grad_all = jit(vmap(jit(grad(Q_j, argnums=(0,1,2,3))), in_axes=(0,0,0,0,0,0,0,0,0,None,None,None,None,0)))
-
-        ## Other jitted functions
-        self.logB_jax = jit(vmap(single_logB, in_axes=(None, 0, 0, 0)))
-        self.B_jax = jit(vmap(single_B,in_axes=(None,0,0,0)))
-        self.expB_jax = jit(expB)
-        self.update_internal_jax = jit(update_internal)
-        self.kill_nodes = jit(kill_dead_nodes)
-        self.log_pred_prob = jit(log_pred_prob)
-        self.pred_ahead = jit(pred_ahead, static_argnames=['future_distance'])
-        self.sum_me = jit(sum_me)
-        self.compute_L = jit(vmap(get_L, (0,0)))
-        self.get_amax = jit(amax)
-        self.invert_L = jit(vmap(invert_l,(0))) #jit
+            var = numpy.diag(numpy.var(self.obs.saved_obs, axis=0))
+        ## every node starts with the same covariance, so one Cholesky factor is shared by all of them
+        fullSigma = numpy.asarray(var * (self.nu + self.d + 1) / (self.N**(2/self.d)), dtype=float)
+
+        ## Optimization is done with L split into L_lower and L_diag elements
+        ## L is defined using cholesky of precision matrix, NOT covariance
+        L = numpy.linalg.cholesky(fullSigma)
+        L = numpy.linalg.inv(L).T
+        self.L = numpy.broadcast_to(L, (self.N,self.d,self.d)).astype(float)
+        self.L_diag = numpy.broadcast_to(numpy.log(numpy.diag(L)), (self.N,self.d)).astype(float)
+        self.L_lower = numpy.tril(self.L,-1)        
+        if self.packed:
+            self.L_lower = pack(self.L_lower, -1)
+        self.sigma_orig = fullSigma
+
+        self.jit_functions()
 
         ## for adam gradients
-        self.m_mu = np.zeros_like(self.mu)
-        self.m_L = np.zeros_like(self.L_lower)
-        self.m_L_diag = np.zeros_like(self.L_diag)
-        self.m_A = np.zeros_like(self.A)
-
-        self.v_mu = np.zeros_like(self.mu)
-        self.v_L = np.zeros_like(self.L_lower)
-        self.v_L_diag = np.zeros_like(self.L_diag)
-        self.v_A = np.zeros_like(self.A)
-
-        ## Variables for keeping track of dead nodes
-        self.dead_nodes = np.arange(0,self.N).tolist()
+        self.m_mu = numpy.zeros_like(self.mu)
+        self.m_L = numpy.zeros_like(self.L_lower)
+        self.m_L_diag = numpy.zeros_like(self.L_diag)
+        self.m_A = numpy.zeros_like(self.A)
+
+        self.v_mu = numpy.zeros_like(self.mu)
+        self.v_L = numpy.zeros_like(self.L_lower)
+        self.v_L_diag = numpy.zeros_like(self.L_diag)
+        self.v_A = numpy.zeros_like(self.A)
+
+        ## Variables for keeping track of dead nodes, kept on device as a fixed-size queue
+        self.dead_order = numpy.arange(0,self.N)      # queue position of each dead node, -1 once alive
+        self.dead_next = numpy.int32(self.N)          # next free queue position
         self.dead_nodes_ind = self.n_thresh*numpy.ones(self.N)
-        self.current_node = 0 
+        self.current_node = numpy.int32(0)
+
+        if warm_start is not None:
+            self.warm_start_nodes(tiling, decay)
+
+        for k in BubblewrapState._fields + ('last_alpha',):
+            a = getattr(self, k, None)
+            if isinstance(a, numpy.ndarray):
+                setattr(self, k, jax.device_put(a.astype(self.dtype) if a.dtype.kind == 'f' else a))
     
+        self.init_tracking()
+
+    def warm_start_nodes(self, tiling, decay=1):
+        ## Overwrite the first N0 nodes with a saved tiling (mu, L, A, n_obs and, for top-k transitions, A_idx),
+        ## e.g. from an earlier session on the same subject. Its evidence carries over as sufficient statistics
+        ## scaled by decay: n_obs, S1 = n_obs mu, S2 = n_obs (Sigma + mu mu^T) and En = n_obs A, so the M-step
+        ## keeps the saved tiles until new data outweighs them (decay=0 keeps only their positions and shapes).
+        ## Saved nodes with at least n_thresh of evidence start alive; the rest, and any nodes beyond N0, wait
+        ## in the dead-node queue for teleports, least evidence first.
+        N0 = tiling['mu'].shape[0]
+        mu = numpy.array(self.mu, dtype=float)
+        mu[:N0] = tiling['mu']
+        L = numpy.array(self.L)
+        L[:N0] = tiling['L']
+        n_obs = numpy.zeros(self.N)
+        n_obs[:N0] = decay * tiling['n_obs']
+        alive = n_obs >= self.n_thresh
+        n_obs[~alive] = 0
+
+        self.mu = mu
+        self.L = L
+        self.L_diag = numpy.log(numpy.diagonal(L, axis1=1, axis2=2))
+        self.L_lower = numpy.tril(L, -1)
+        if self.packed:
+            self.L_lower = pack(self.L_lower, -1)
+        self.m_L = numpy.zeros_like(self.L_lower)
+        self.v_L = numpy.zeros_like(self.L_lower)
+        self.mu_orig = mu.copy()
+        self.mus_orig = self.get_mus0(self.mu_orig)
+
+        self.log_A, self.A_idx = warm_start_transitions(numpy.asarray(self.log_A), self.A_idx, tiling.get('A'),
+                                                        tiling.get('A_idx'), self.transition_k)
+        ## rows beyond N0 keep their fresh transitions
+        self.A = numpy.array(self.A)
+        self.A[:N0] = numpy.asarray(sm(self.log_A[:N0]))
+
+        ## evidence as sufficient statistics
+        inv = numpy.linalg.inv(L)
+        sigma = numpy.swapaxes(inv, 1, 2) @ inv
+        S2 = n_obs[:,None,None] * (sigma + mu[:,:,None] * mu[:,None,:])
+        self.S1 = n_obs[:,None] * mu
+        self.S2 = pack(S2) if self.packed else S2
+        self.En = n_obs[:,None] * self.A
+        self.n_obs = n_obs
+        self.alpha = n_obs / numpy.sum(n_obs) if numpy.any(alive) else numpy.asarray(self.alpha)
+        self.last_alpha = self.alpha.copy()
+
+        ## dead-node queue: -1 for live nodes, dead ones in order of their (zeroed) evidence
+        dead = numpy.flatnonzero(~alive)
+        dead = dead[numpy.argsort(n_obs[dead], kind='stable')]
+        self.dead_order = -numpy.ones(self.N, dtype=int)
+        self.dead_order[dead] = numpy.arange(len(dead))
+        self.dead_next = numpy.int32(len(dead))
+        self.dead_nodes_ind = numpy.where(alive, 0, self.n_thresh)
+
+    def jit_functions(self):
+        ## The compiled kernels of the eager path. They are module-level, so every model (and, with
+        ## enable_compilation_cache, every later process) of the same shapes reuses their executables
+        ## instead of compiling its own wrappers.
+        self.grad_all = grad_all_packed_jax if self.packed else grad_all_jax
+        self.logB_jax = logB_jax
+        self.B_jax = B_jax
+        self.update_internal_jax = update_internal
+        self.log_pred_prob = log_pred_prob
+        self.pred_ahead = pred_ahead
+        self.sum_me = sum_me
+        self.compute_L = compute_L_jax
+        self.invert_L = invert_L_jax
+
+    def init_tracking(self):
         ## Variables for tracking progress
-        self.pred = []
-        self.pred_far = []
-        self.teleported_times = []
-        self.time_em = []
-        self.time_observe = []
-        self.time_updates = []
-        self.time_grad_Q = []
-        self.time_pred = []
-        self.entropy_list = []
-        self.loss = []
+        ## step() writes (log_pred, entropy, pred_far) into a device ring buffer inside its compiled call;
+        ## full rings (and any read of pred, entropy_list or pred_far) move them to the host in one transfer
+        self.ring = np.zeros((1024, 3))
+        self.ring_pos = 0
+        self.ring_far = []          # whether each ring row has a pred_far
+        self.pred = MetricBuffer(self.metrics_maxlen, before_read=self.flush_ring)
+        self.pred_far = MetricBuffer(self.metrics_maxlen, before_read=self.flush_ring)
+        self.entropy_list = MetricBuffer(self.metrics_maxlen, before_read=self.flush_ring)
+        self.teleported_times = MetricBuffer(self.metrics_maxlen)
+        self.loss = MetricBuffer(self.metrics_maxlen)
 
         self.t = 1
+        self.index = None           # spatial index over the tiles, see build_index
 
 
+    @timed('time_observe')
     def observe(self, x, future_x=None, b=None):
         # Get new data point and update observation history
+        x, future_x = self.as_input(x, sample=not self.batch), self.as_input(future_x, sample=True)
 
         ## Do all observations, and then update mu0, sigma0
         if self.batch:
-            for o in x: # x array of observations
-                self.obs.new_obs(o)
+            self.obs.new_obs_batch(x) # x array of observations
         else:
                 self.obs.new_obs(x)
 
         self.future_x = future_x
         
-        if not self.go_fast and self.obs.cov is not None and self.mu_orig is not None:
-            lamr = 0.02
-            eta = np.sqrt(lamr * np.diag(self.obs.cov))
-            
-            self.mu_orig = (1-lamr)*self.mu_orig + lamr*self.obs.mean + eta*numpy.random.normal(size=(self.N, self.d))
-            self.sigma_orig = self.obs.cov * (self.nu + self.d + 1) / (self.N**(2/self.d))   
+        ## prior drift in one compiled call driven by self.key, the same draws as the fused step
+        if not self.go_fast and self.mu_orig is not None:
+            self.key, self.mu_orig, self.sigma_orig = drift_prior(self.key, self.mu_orig, self.sigma_orig, self.obs.mean,
+                                                                  self.obs.cov, self.obs.n_obs, self.nu)
          
 
+    @timed('time_em')
     def e_step(self):
         # take E step; after observation
         if self.batch:
-            for o in self.obs.saved_obs:
-                self.single_e_step(o)
+            self.batch_e_step(self.as_input(self.obs.saved_obs))
+        elif self.A_idx is not None or self.active_size is not None:
+            ## top-k transitions and active sets only run through the state-based kernel; its one-sample form
+            ## (lazy_update_internal with lazy_decay) writes only the active rows, the block scan all of them
+            self.batch_e_step(self.as_input(self.obs.curr))
         else:
-            self.single_e_step(self.obs.curr)
+            self.single_e_step(self.as_input(self.obs.curr))
+
+    def as_input(self, x, sample=False):
+        ## data at the dtype of the model, on the host, so it doesn't promote a float32 state under x64;
+        ## with sample, one (d,) observation, also when given as a (1, d) slice as in run_bubblewrap.py
+        if x is None:
+            return None
+        x = numpy.asarray(x, dtype=self.dtype)
+        return x.reshape(self.d) if sample else x
+
+
+    def batch_e_step(self, X):
+        ## whole (b, d) block in one compiled scan; same recursion as calling single_e_step per row.
+        ## A single (d,) sample runs the one-step e_step_state instead.
+        b = X.shape[0] if X.ndim == 2 else 1
+        self.beta = 1 + 10/(self.t+b)
+
+        state, metrics = e_step_jax(self.get_state(), X, self.future_x, self.params)
+        self.set_state(state)
+        new_log_pred, ent, pred_far = (np.atleast_1d(m) for m in metrics)
+
+        if not self.go_fast:
+            self.flush_ring()
+            self.pred.extend(new_log_pred)
+            self.entropy_list.extend(ent)
+            if self.future_x is not None:
+                self.pred_far.extend(pred_far)
+
+        self.t += b
 
 
     def single_e_step(self, x):
@@ -192,14 +418,7 @@ class Bubblewrap():
 
         ### Compute log predictive probability and entropy; turn off for faster code 
         if not self.go_fast:
-            new_log_pred = self.log_pred_prob(self.B, self.A, self.alpha) 
-            self.pred.append(new_log_pred)
-            ent = entropy(self.A, self.alpha)
-            self.entropy_list.append(ent)
-            if self.future_x is not None:
-                future_B = self.logB_jax(self.future_x, self.mu, self.L, self.L_diag)
-                pred_far = self.pred_ahead(future_B, self.A, self.alpha, self.future_distance)
-                self.pred_far.append(pred_far)
+            self.track_pred()
 
         self.update_B(x)
 
@@ -208,64 +427,97 @@ class Bubblewrap():
         self.t += 1     
 
 
-    def update_B(self, x):
-        
-        if np.max(self.B) < self.B_thresh:
-            if not (self.dead_nodes):
-                target = numpy.argmin(self.n_obs)
+    @timed('time_pred')
+    def track_pred(self):
+        self.flush_ring()
+        new_log_pred = self.log_pred_prob(self.B, self.A, self.alpha) 
+        self.pred.append(new_log_pred)
+        ent = entropy(self.A, self.alpha)
+        self.entropy_list.append(ent)
+        if self.future_x is not None:
+            future_B = self.logB_jax(self.future_x, self.mu, self.L, self.L_diag)
+            pred_far = self.pred_ahead(future_B, self.A, self.alpha, self.future_distance)
+            self.pred_far.append(pred_far)
 
-                if self.printing:
-                    print('-------------- killing a node: ', target)
-
-                n_obs = numpy.array(self.n_obs)
-                n_obs[target] = 0
-                self.n_obs = n_obs
-
-                self.remove_dead_nodes()
-
-            node = self.teleport_node(x)
-            self.B = self.logB_jax(x, self.mu, self.L, self.L_diag)
-
-        self.current_node, self.B = self.expB_jax(self.B)
-
-
-    def remove_dead_nodes(self):
-
-        ma = (self.n_obs + self.dead_nodes_ind) < self.n_thresh
-
-        if ma.any():
-            ind2 = self.get_amax(ma) 
-        
-            # try:
-            self.n_obs, self.S1, self.S2, self.En, self.log_A = self.kill_nodes(ind2, self.n_thresh, self.n_obs, self.S1, self.S2, self.En, self.log_A)
-            actual_ind = int(ind2)
-            self.dead_nodes.append(actual_ind)
-            self.dead_nodes_ind[actual_ind] = self.n_thresh
-            if self.printing:
-                print('Removed dead node ', actual_ind, ' at time ', self.t)
-            
-
-    def teleport_node(self, x):
-        node = self.dead_nodes.pop(0)
-        
-        mu = numpy.array(self.mu)
-        mu[node] = x
-        self.mu = mu
-
-        alpha = numpy.array(self.alpha)
-        alpha[node] = 1        
-        self.alpha = alpha
-
-        self.dead_nodes_ind[node] = 0
+    @timed('time_updates')
+    def update_B(self, x):
+        ## Teleport and kill decisions stay on device; nothing here waits on the result
+        (self.current_node, self.B, self.mu, self.alpha, self.n_obs, self.dead_order, self.dead_next, self.dead_nodes_ind,
+         node, killed) = update_B_nodes(x, self.B, self.mu, self.L, self.L_diag, self.alpha, self.n_obs, self.dead_order, self.dead_next, self.dead_nodes_ind, self.B_thresh, self.n_thresh)
+        self.S1, self.S2, self.log_A = kill_dead_nodes(killed, self.S1, self.S2, self.log_A, self.A_idx)
 
         if self.printing:
-            print('Teleported node ', node, ' to current data location at time ', self.t)
-            self.teleported_times.append(self.t)
-
-        return node
+            if killed >= 0:
+                print('Removed dead node ', int(killed), ' at time ', self.t)
+            if node >= 0:
+                print('Teleported node ', int(node), ' to current data location at time ', self.t)
+                self.teleported_times.append(self.t)
+
+    @property
+    def dead_nodes(self):
+        ## dead nodes in teleport order; reading this syncs with the device
+        dead_order = numpy.asarray(self.dead_order)
+        return numpy.argsort(dead_order)[numpy.sum(dead_order < 0):].tolist()
+
+
+    def m_step_due(self, b=None):
+        ## whether the scheduled M-step runs after the last b samples (default: one batch)
+        if self.m_step_period is not None:
+            return time.perf_counter() - self.last_m_step >= self.m_step_period
+        b = self.batch_size if b is None else b
+        return self.t // self.m_step_every > (self.t - b) // self.m_step_every
+
+    def start_learner(self, mode='fit'):
+        ## run the M-step in a background thread on snapshots of the state. step() (or e_step + grad_Q) then
+        ## only runs the E-step with the last published parameters and swaps in newer ones between samples,
+        ## so it never waits on an M-step however long that takes
+        self.learner_mode = mode
+        self.learned = None
+        self.snapshots = queue.Queue(maxsize=1)
+        self.learner = threading.Thread(target=self.learn, daemon=True)
+        self.learner.start()
+        self.snapshots.put(self.get_state())
+
+    def stop_learner(self):
+        ## wait for the M-step in flight and swap it in
+        self.snapshots.put(None)
+        self.learner.join()
+        self.learner = None
+        self.swap_learned()
+
+    def learn(self):
+        ## learner thread: M-step on each snapshot, published as (snapshot, result) in one assignment
+        while True:
+            snapshot = self.snapshots.get()
+            if snapshot is None:
+                return
+            learned = grad_Q_jax(snapshot, self.params, self.learner_mode)
+            jax.block_until_ready(learned)
+            self.learned = (snapshot, learned)
+
+    def swap_learned(self):
+        ## foreground side: merge the published M-step, if there is one, and hand the learner a new snapshot
+        learned = self.learned
+        if learned is None:
+            return
+        self.learned = None
+        self.set_state(merge_learned(self.get_state(), *learned))
+        if self.learner is not None:
+            self.snapshots.put_nowait(self.get_state())
+
+    @timed('time_grad_Q')
+    def grad_Q(self,mode='fit'):
+        if self.learner is not None:
+            self.swap_learned()
+            return
 
+        if not self.m_step_due():
+            return
+        self.last_m_step = time.perf_counter()
 
-    def grad_Q(self,mode='fit'):
+        if self.active_size is not None or self.m_step != 'adam':
+            self.set_state(grad_Q_jax(self.get_state(), self.params, mode))
+            return
 
         divisor = 1+self.sum_me(self.En)
         (grad_mu, grad_L, grad_L_diag, grad_A) = self.grad_all(self.mu, self.L_lower, self.L_diag, self.log_A, self.S1, self.lam, self.S2, self.n_obs, self.En, self.nu, self.sigma_orig, self.beta, self.d, self.mu_orig)
@@ -282,16 +534,277 @@ class Bubblewrap():
 
     def run_adam(self, mu, L, L_diag, A):
         ## inputs are gradients
-        self.m_mu, self.v_mu, self.mu = single_adam(self.step, self.m_mu, self.v_mu, mu, self.t, self.mu)
-        self.m_L, self.v_L, self.L_lower = single_adam(self.step, self.m_L, self.v_L, L, self.t, self.L_lower)
-        self.m_L_diag, self.v_L_diag, self.L_diag = single_adam(self.step, self.m_L_diag, self.v_L_diag, L_diag, self.t, self.L_diag)
-        self.m_A, self.v_A, self.log_A = single_adam(self.step, self.m_A, self.v_A, A, self.t, self.log_A)
+        self.m_mu, self.v_mu, self.mu = single_adam(self.step_size, self.m_mu, self.v_mu, mu, self.t, self.mu)
+        self.m_L, self.v_L, self.L_lower = single_adam(self.step_size, self.m_L, self.v_L, L, self.t, self.L_lower)
+        self.m_L_diag, self.v_L_diag, self.L_diag = single_adam(self.step_size, self.m_L_diag, self.v_L_diag, L_diag, self.t, self.L_diag)
+        self.m_A, self.v_A, self.log_A = single_adam(self.step_size, self.m_A, self.v_A, A, self.t, self.log_A)
 
     def run_adam_fixedmu(self, L, L_diag, A):
         ## inputs are gradients
-        self.m_L, self.v_L, self.L_lower = single_adam(self.step, self.m_L, self.v_L, L, self.t, self.L_lower)
-        self.m_L_diag, self.v_L_diag, self.L_diag = single_adam(self.step, self.m_L_diag, self.v_L_diag, L_diag, self.t, self.L_diag)
-        self.m_A, self.v_A, self.log_A = single_adam(self.step, self.m_A, self.v_A, A, self.t, self.log_A)
+        self.m_L, self.v_L, self.L_lower = single_adam(self.step_size, self.m_L, self.v_L, L, self.t, self.L_lower)
+        self.m_L_diag, self.v_L_diag, self.L_diag = single_adam(self.step_size, self.m_L_diag, self.v_L_diag, L_diag, self.t, self.L_diag)
+        self.m_A, self.v_A, self.log_A = single_adam(self.step_size, self.m_A, self.v_A, A, self.t, self.log_A)
+
+    @timed('time_step')
+    def step(self, x, future_x=None, mode='fit'):
+        # observe + e_step + grad_Q for one sample (or one (b, d) block in batch mode) as a single compiled dispatch
+        x, future_x = self.as_input(x, sample=not self.batch), self.as_input(future_x, sample=True)
+        b = x.shape[0] if self.batch else 1
+
+        self.future_x = future_x
+        self.beta = 1 + 10/(self.t+b)
+
+        due = None
+        if self.learner is not None:
+            due = numpy.bool_(False)
+        elif self.m_step_period is not None:
+            due = numpy.bool_(time.perf_counter() - self.last_m_step >= self.m_step_period)
+            if due:
+                self.last_m_step = time.perf_counter()
+
+        if self.go_fast or self.batch:
+            state, (new_log_pred, ent, pred_far) = fused_step(self.get_state(), x, future_x, self.params, mode, due)
+        else:
+            state, self.ring = recorded_step(self.get_state(), self.ring, self.ring_pos, x, future_x, self.params, mode, due)
+        self.set_state(state)
+
+        self.obs.store(x)
+        self.obs.curr = x[-1] if self.batch else x
+        self.obs.n_obs += b
+
+        if not self.go_fast:
+            if self.batch:
+                self.flush_ring()
+                self.pred.extend(new_log_pred)
+                self.entropy_list.extend(ent)
+                if future_x is not None:
+                    self.pred_far.extend(pred_far)
+            else:
+                self.ring_far.append(future_x is not None)
+                self.ring_pos += 1
+                if self.ring_pos == self.ring.shape[0]:
+                    self.flush_ring()
+
+        self.t += b
+        if self.learner is not None:
+            self.swap_learned()
+
+    def fit_stream(self, data, mode='fit'):
+        # step() over every row of a (T, d) recording inside one lax.scan; the M-step runs every m_step_every samples
+        if self.batch:
+            raise ValueError("fit_stream() runs one observation at a time; use observe/e_step/grad_Q in batch mode")
+        if self.learner is not None:
+            raise ValueError("fit_stream() runs its own M-steps; stop_learner() first")
+
+        T = data.shape[0]
+        data = np.asarray(self.as_input(data))
+
+        ## row t is scored future_distance steps ahead against row t + future_distance - 1, as in run_bubblewrap.py
+        future_ind = numpy.arange(T) + self.future_distance - 1
+        has_future = future_ind < T
+        future_data = data[numpy.minimum(future_ind, T-1)]
+
+        state, (pred, entropy, pred_far) = fit_stream_state(self.get_state(), data, future_data, has_future, self.params, mode)
+        self.set_state(state)
+
+        self.obs.store(data[-self.obs.M:])
+        self.obs.n_obs += T
+        self.beta = 1 + 10/(self.t+T)
+        self.t += T
+
+        if not self.go_fast:
+            self.flush_ring()
+            self.pred.extend(pred)
+            self.entropy_list.extend(entropy)
+            self.pred_far.extend(numpy.asarray(pred_far)[has_future])
+
+        return state, pred, pred_far, entropy
+
+    def warmup(self, future=True, stream_length=None, mode='fit'):
+        ## Compile, after init_nodes and before any data arrives, what the first calls will run: step (with or
+        ## without a future_x), observe + e_step + grad_Q and, for a stream_length, fit_stream on that many
+        ## rows. Everything runs on stand-in data and the results are thrown away, so the model is unchanged.
+        ## Returns the seconds spent, which is nearly all compile time (little with enable_compilation_cache).
+        if self.mu_orig is None:
+            raise ValueError("warmup() needs the nodes; call init_nodes() first")
+        start = time.perf_counter()
+        b = self.batch_size
+        x = numpy.zeros((b, self.d) if self.batch else self.d, dtype=self.dtype)
+        future_x = numpy.zeros(self.d, dtype=self.dtype) if future else None
+        state = self.get_state()
+
+        due = None
+        if self.learner is not None or self.m_step_period is not None:
+            due = numpy.bool_(False)
+        if self.go_fast or self.batch:
+            out = fused_step(state, x, future_x, self.params, mode, due)
+        else:
+            out = recorded_step(state, np.zeros_like(self.ring), self.ring_pos, x, future_x, self.params, mode, due)
+        if stream_length is not None and not self.batch:
+            data = numpy.zeros((stream_length, self.d), dtype=self.dtype)
+            has_future = numpy.arange(stream_length) + self.future_distance - 1 < stream_length
+            out = (out, fit_stream_state(state, data, data, has_future, self.params, mode))
+
+        ## the eager path on a throwaway copy, at a t where the M-step is due
+        if self.learner is None:
+            clone = copy.copy(self)
+            clone.obs = copy.deepcopy(self.obs)
+            clone.init_tracking()
+            clone.timing = clone.printing = False
+            clone.t = self.m_step_every * (b + 1) - b
+            clone.last_m_step = -numpy.inf
+            clone.observe(x, future_x=future_x)
+            clone.e_step()
+            clone.grad_Q(mode)
+            out = (out, clone.get_state())
+        jax.block_until_ready(out)
+        return time.perf_counter() - start
+
+    def forecast(self, horizons=tuple(range(1, 51))):
+        ## probability of each node h samples after the last one, one row per h in horizons;
+        ## forecast(horizons) @ bw.mu is the predicted mean position at each horizon
+        return forecast_nodes(self.A, self.alpha, tuple(horizons), self.A_idx)
+
+    def pred_horizons(self, future_x, horizons=tuple(range(1, 51))):
+        ## log p(x_(t+h) | x_1..x_t) for every h in horizons, with x_t the last sample absorbed by the E-step:
+        ## future_x is either one point per horizon, (len(horizons), d), or a single (d,) point scored at all of them
+        return horizon_log_pred(np.asarray(future_x), self.A, self.alpha, self.mu, self.L, self.L_diag, tuple(horizons), self.A_idx)
+
+    def flush_ring(self):
+        ## move the metrics recorded by step() to the host, in one transfer
+        if self.ring_pos == 0:
+            return
+        rows = numpy.asarray(self.ring)[:self.ring_pos]
+        self.ring_pos = 0
+        self.pred.store(rows[:, 0])
+        self.entropy_list.store(rows[:, 1])
+        self.pred_far.store(rows[numpy.array(self.ring_far, dtype=bool), 2])
+        self.ring_far = []
+
+    def sync(self):
+        ## wait for all device work dispatched for this model
+        jax.block_until_ready([v for v in vars(self).values() if isinstance(v, jax.Array)] + [self.obs.mean, self.obs.cov])
+
+    def timing_summary(self, bins=20):
+        ## per-phase latency in microseconds: count, mean, p50, p90, p99 and max, and a histogram over
+        ## log-spaced bins; phases that were never timed are left out
+        summary = {}
+        for name in ['observe', 'em', 'pred', 'updates', 'grad_Q', 'step']:
+            us = 1e6 * numpy.asarray(getattr(self, 'time_' + name))
+            if len(us) == 0:
+                continue
+            counts, edges = numpy.histogram(us, bins=numpy.geomspace(max(us.min(), 1e-3), us.max() * (1 + 1e-9), bins + 1))
+            summary[name] = {'count': len(us), 'mean': float(us.mean()), 'p50': float(numpy.percentile(us, 50)),
+                             'p90': float(numpy.percentile(us, 90)), 'p99': float(numpy.percentile(us, 99)),
+                             'max': float(us.max()), 'hist_counts': counts.tolist(), 'hist_edges': edges.tolist()}
+        return summary
+
+    def export_timing(self, path):
+        ## timing_summary() as JSON
+        with open(path, 'w') as f:
+            json.dump(self.timing_summary(), f, indent=1)
+
+    def print_timing(self):
+        for name, s in self.timing_summary().items():
+            print(f"{name:>8}: {s['count']:6d} calls, p50 {s['p50']:9.1f} us, p99 {s['p99']:9.1f} us, max {s['max']:9.1f} us")
+
+    def trace(self, log_dir):
+        ## context manager recording a jax.profiler trace (TensorBoard / Perfetto) to log_dir; with timing on,
+        ## the timed phases show up in it as named ranges:  with bw.trace('/tmp/bw'): bw.step(x)
+        return jax.profiler.trace(log_dir)
+
+    @property
+    def params(self):
+        return BubblewrapParams(self.eps, self.nu, self.step_size, self.B_thresh, self.n_thresh, self.go_fast, self.future_distance, self.active_size, self.lazy_decay, self.m_step, self.m_step_every)
+
+    def get_state(self):
+        ## Snapshot of the model as an immutable pytree; see BubblewrapState
+        ## running data statistics are only tracked when not going fast
+        obs_mean, obs_cov = self.obs.mean, self.obs.cov
+        if obs_mean is None:
+            obs_mean = numpy.zeros(self.d)
+        if obs_cov is None:
+            obs_cov = numpy.zeros((self.d, self.d))
+
+        ## leaves are passed as-is (NumPy, JAX or Python scalars); jit canonicalizes them on the way in
+        return BubblewrapState(self.mu, self.L, self.L_lower, self.L_diag, self.log_A, self.A, self.A_idx, self.alpha, self.B,
+                               self.En, self.S1, self.S2, self.n_obs, self.touched, self.lam, self.mu_orig, self.sigma_orig,
+                               self.m_mu, self.m_L, self.m_L_diag, self.m_A, self.v_mu, self.v_L, self.v_L_diag, self.v_A,
+                               self.dead_order, self.dead_next, self.dead_nodes_ind, self.current_node, self.t, self.key,
+                               obs_mean, obs_cov, self.obs.n_obs)
+
+    def set_state(self, state):
+        (self.mu, self.L, self.L_lower, self.L_diag, self.log_A, self.A, self.A_idx, self.alpha, self.B,
+         self.En, self.S1, self.S2, self.n_obs, self.touched, self.lam, self.mu_orig, self.sigma_orig,
+         self.m_mu, self.m_L, self.m_L_diag, self.m_A, self.v_mu, self.v_L, self.v_L_diag, self.v_A,
+         self.dead_order, self.dead_next, self.dead_nodes_ind, self.current_node, _, self.key, obs_mean, obs_cov, _) = state
+
+        if not self.go_fast:
+            self.obs.mean = obs_mean
+            self.obs.cov = obs_cov
+
+    def materialize(self):
+        ## bring every row of S1, S2 and En up to date, e.g. before saving them; a no-op without lazy_decay
+        if self.lazy_decay:
+            self.set_state(materialize_state(self.get_state(), self.params))
+
+    @property
+    def config(self):
+        ## constructor arguments that rebuild this model, e.g. in load_state
+        return dict(num=self.N, dim=self.d, seed=self.seed, M=self.obs.M, step=self.step_size, lam=self.lam_0, eps=self.eps, nu=self.nu,
+                    B_thresh=self.B_thresh, n_thresh=self.n_thresh, t_wait=self.t_wait, batch=self.batch, batch_size=self.batch_size,
+                    go_fast=self.go_fast, future_distance=self.future_distance, transition_k=self.transition_k,
+                    active_size=self.active_size, lazy_decay=self.lazy_decay, packed=self.packed, m_step=self.m_step,
+                    m_step_every=self.m_step_every, m_step_period=self.m_step_period, metrics_maxlen=self.metrics_maxlen,
+                    timing=self.timing, dtype=self.dtype.name, bucket=self.bucket)
+
+    def save_state(self, path, compress=None, metrics=True):
+        ## Everything needed to resume this model in one file (see write_checkpoint): the BubblewrapState
+        ## (parameters, Adam moments, S1/S2/En, dead-node queue, t, PRNG key, data statistics), the recent
+        ## observations and, with metrics, the tracked pred/pred_far/entropy.
+        ## compress='float16' or 'float32' stores the two largest arrays, S2 and En, at that precision.
+        if self.learner is not None:
+            raise ValueError("save_state() needs the M-step in the foreground; stop_learner() first")
+        self.materialize()
+        self.flush_ring()
+
+        arrays = {k: v for k, v in self.get_state()._asdict().items() if v is not None}
+        arrays['saved_obs'] = self.obs.saved_obs
+        if metrics:
+            for k in ['pred', 'pred_far', 'entropy_list', 'teleported_times']:
+                arrays['metric_' + k] = numpy.asarray(getattr(self, k))
+        stored = {k: compress for k in ['S2', 'En'] if compress is not None}
+
+        header = {'config': self.config, 't': self.t, 'beta': getattr(self, 'beta', None),
+                  'obs_n': self.obs.n_obs}
+        write_checkpoint(path, header, arrays, stored)
+
+    @classmethod
+    def load_state(cls, path):
+        ## a new Bubblewrap resumed from a save_state file; the arrays are read from a memory map of the file
+        header, arrays = read_checkpoint(path)
+        bw = cls(**header['config'])
+        bw.jit_functions()
+        bw.init_tracking()
+
+        fields = {k: (jax.device_put(arrays[k]) if k in arrays else None) for k in BubblewrapState._fields}
+        bw.set_state(BubblewrapState(**fields))
+        bw.t = header['t']
+        if header['beta'] is not None:
+            bw.beta = header['beta']
+        bw.last_alpha = bw.alpha
+        bw.mus_orig = bw.get_mus0(bw.mu_orig)
+
+        if len(arrays['saved_obs']):
+            bw.obs.store(arrays['saved_obs'])
+        bw.obs.n_obs = header['obs_n']
+        if bw.go_fast:
+            bw.obs.mean = bw.obs.cov = None
+
+        for k in ['pred', 'pred_far', 'entropy_list', 'teleported_times']:
+            if 'metric_' + k in arrays:
+                getattr(bw, k).store(numpy.array(arrays['metric_' + k]))
+        return bw
 
     def get_fisher_ub(self):
 
@@ -308,16 +821,111 @@ class Bubblewrap():
         #lInv = self.invert_L(self.L)
         return self.L.transpose(0,2,1) @ self.L
     
-    def posterior(self,x):
+    def query(self, X, horizon=1, chunk=1024, nearest=None, posterior=True):
+        ## density queries at the rows of an (M, d) array, chunk rows at a time; see query_points. With nearest=k
+        ## only the k densest tiles at each point, as the spatial index finds them (see TileIndex.candidates), are
+        ## evaluated, and the rest count as zero density
+        near = None
+        if nearest is not None:
+            near = self.build_index().candidates(X, nearest)
+        return query_points(np.asarray(X), self.mu, self.L, self.L_diag, self.n_obs, self.A, self.alpha, horizon, chunk, self.A_idx, near, posterior)
+
+    def build_index(self):
+        ## TileIndex over the current tiles, rebuilt only once the model has moved on since the last one
+        if self.index is None or self.index_t != self.t:
+            self.index = TileIndex(numpy.asarray(self.mu), numpy.asarray(self.L), numpy.asarray(self.L_diag),
+                                   numpy.asarray(self.n_obs))
+            self.index_t = self.t
+        return self.index
+
+    def log_density(self, X, chunk=1024, nearest=None):
+        return self.query(X, chunk=chunk, nearest=nearest, posterior=False)[0]
+
+    def posterior(self, X, chunk=1024, nearest=None):
+        ## (M, N) probability of each node given each point
+        return self.query(X, chunk=chunk, nearest=nearest)[1]
+
+
+class BubblewrapEnsemble():
+    ## K independent Bubblewrap models, stacked along a leading axis and advanced by one vmapped step
+    def __init__(self, num_streams, num, dim, seed=42, **kwargs):
+        self.K = num_streams
+        self.models = [Bubblewrap(num, dim, seed=seed+k, **kwargs) for k in range(self.K)]
+        self.state = None
+
+    def observe(self, X):
+        # (K, d) observations, or (K, b, d) blocks in batch mode; only used before init_nodes
+        for bw, x in zip(self.models, X):
+            bw.observe(x)
+
+    def init_nodes(self):
+        for bw in self.models:
+            bw.init_nodes()
+        self.state = jax.tree.map(lambda *leaves: np.stack(leaves), *(bw.get_state() for bw in self.models))
+        self.t = self.models[0].t
+
+        maxlen = self.models[0].metrics_maxlen
+        self.pred = MetricBuffer(maxlen)
+        self.pred_far = MetricBuffer(maxlen)
+        self.entropy_list = MetricBuffer(maxlen)
+
+    @property
+    def params(self):
+        return self.models[0].params
+
+    def step(self, X, future_X=None, mode='fit'):
+        # fused observe + e_step + grad_Q for all K streams; X is (K, d), or (K, b, d) in batch mode
+        self.state, (new_log_pred, ent, pred_far) = ensemble_step(self.state, X, future_X, self.params, mode)
 
-        likelihoods = self.B_jax
+        if not self.params.go_fast:
+            self.pred.append(new_log_pred)
+            self.entropy_list.append(ent)
+            if future_X is not None:
+                self.pred_far.append(pred_far)
 
+        self.t += X.shape[1] if self.models[0].batch else 1
+
+    def model(self, k):
+        ## the Bubblewrap for stream k with the current stacked state written back into it
+        bw = self.models[k]
+        state = jax.tree.map(lambda leaf: leaf[k], self.state)
+        bw.set_state(state)
+        bw.obs.n_obs = int(state.obs_n)
+        bw.t = self.t
+        bw.beta = 1 + 10/self.t
+        return bw
 
 
 beta1 = 0.99
 beta2 = 0.999
 
 
+## Packed storage of the symmetric and triangular per-node arrays (see packed)
+def pack(a, k=0):
+    ## lower triangle (diagonal offset k) of the trailing d x d axes, row by row
+    d = a.shape[-1]
+    i, j = numpy.tril_indices(d, k)
+    return a.reshape(a.shape[:-2] + (d*d,))[..., i*d + j]
+
+def unpack(p, d, k=0, symmetric=False):
+    ## inverse of pack, zero outside the stored triangle or mirrored into the upper one;
+    ## a gather from p padded with one zero
+    i, j = numpy.tril_indices(d, k)
+    ind = numpy.full((d, d), len(i))
+    ind[i, j] = numpy.arange(len(i))
+    if symmetric:
+        ind[j, i] = numpy.arange(len(i))
+    return np.concatenate([p, np.zeros(p.shape[:-1] + (1,), dtype=p.dtype)], axis=-1)[..., ind]
+
+def outer_like(x, S2):
+    ## x x^T laid out like the rows of S2: full d x d, or packed lower triangle
+    xx = x[:,np.newaxis] * x
+    return xx if S2.ndim == 3 else pack(xx)
+
+def bcast(w, a):
+    ## per-row weights w (n,) broadcast against the trailing axes of a
+    return w.reshape(w.shape + (1,)*(a.ndim - 1))
+
 
 ### A ton of jitted functions for fast code execution
 @jit 
@@ -354,7 +962,10 @@ def amax(A):
 
 @jit
 def get_L(x, y):
+    if y.ndim == 1:
+        y = unpack(y, x.shape[0], -1)
     return np.tril(np.diag(np.exp(x) + epsilon) + np.tril(y,-1))
+
 @jit
 def get_L_inv(L):
     return np.linalg.inv(L)
@@ -408,52 +1019,868 @@ def single_logB(x, mu, L, L_diag):
     return B
 
 @jit
-def expB(B):
-    max_Bind = np.argmax(B)
-    current_node = max_Bind
-    B -= B[max_Bind]
-    B = np.exp(B)
-    return current_node, B
+def propagate(alpha, A, A_idx=None):
+    ## alpha @ A for dense (N, N) transitions or top-k (N, k) transitions into A_idx
+    if A_idx is None:
+        return alpha.dot(A)
+    return np.zeros_like(alpha).at[A_idx].add(alpha[:,np.newaxis] * A)
+
+def forward_alpha(pred, B):
+    ## alpha proportional to pred * exp(B) for the one-step prediction pred = last_alpha @ A and log likelihoods
+    ## B, normalized in log space, so a node far below the best one gets its (small) share rather than
+    ## underflowing to zero. If pred has no mass on any node B can explain, B alone decides instead of alpha
+    ## collapsing to zero. Returns alpha and the log normalizer, log sum_j pred_j exp(B_j).
+    log_joint = np.log(pred) + B
+    log_joint = np.where(np.isfinite(lse(log_joint)), log_joint, B)
+    log_norm = lse(log_joint)
+    return np.exp(log_joint - log_norm), log_norm
+
+def transition_posterior(last_alpha, A, pred, alpha):
+    ## expected i -> j transitions for this step, last_alpha_i A_ij exp(B_j) / norm, written as
+    ## (last_alpha_i A_ij / pred_j) alpha_j: both factors are at most 1, so nothing overflows in float32
+    ## however unlikely the transition was. pred and alpha are indexed like the columns of A.
+    return last_alpha[:,np.newaxis] * A / np.where(pred > 0, pred, 1) * alpha
 
 @jit
-def update_internal(A, B, last_alpha, En, eps, S1, obs_curr, S2, n_obs):
-    gamma = B * A / (last_alpha.dot(A).dot(B) + 1e-16)
-    alpha = last_alpha.dot(gamma)
-    En = gamma * last_alpha[:,np.newaxis] + (1-eps) * En
+def update_internal(A, B, last_alpha, En, eps, S1, obs_curr, S2, n_obs, A_idx=None):
+    ## B holds log likelihoods; gamma is the (N, N) or (N, k) posterior of this step's transitions
+    pred = propagate(last_alpha, A, A_idx)
+    alpha, _ = forward_alpha(pred, B)
+    if A_idx is None:
+        gamma = transition_posterior(last_alpha, A, pred, alpha)
+    else:
+        gamma = transition_posterior(last_alpha, A, pred[A_idx], alpha[A_idx])
+    En = gamma + (1-eps) * En
     S1 = (1 - eps)*S1 + alpha[:,np.newaxis] * obs_curr
-    S2 = (1 - eps)*S2 + alpha[:,np.newaxis,np.newaxis] * (obs_curr[:,np.newaxis] * obs_curr.T)
+    S2 = (1 - eps)*S2 + bcast(alpha, S2) * outer_like(obs_curr, S2)
     n_obs = (1 - eps)*n_obs + alpha
     return gamma, alpha, En, S1, S2, n_obs
 
+@partial(jit, static_argnames=('m',))
+def lazy_update_internal(A, B, last_alpha, En, eps, S1, obs_curr, S2, n_obs, touched, t, m, A_idx=None):
+    ## update_internal for step t -> t+1 writing only the m rows with the most mass before and the m with
+    ## the most mass after the step; every other row of S1, S2 and En is owed (1-eps)^(t - touched) of decay,
+    ## applied whenever it is read (see decayed). n_obs is only N long and teleports read all of it, so it
+    ## is decayed eagerly.
+    R = lax.top_k(last_alpha, m)[1]
+    last_alpha = np.zeros_like(last_alpha).at[R].set(last_alpha[R])
+    if A_idx is None:
+        pred = last_alpha[R] @ A[R]
+    else:
+        pred = np.zeros_like(last_alpha).at[A_idx[R]].add(last_alpha[R,np.newaxis] * A[R])
+    alpha, _ = forward_alpha(pred, B)
+
+    ## duplicates in rows compute identical values, so the scatters below are still well defined
+    rows = np.concatenate([R, lax.top_k(alpha, m)[1]])
+    if A_idx is None:
+        gamma = transition_posterior(last_alpha[rows], A[rows], pred, alpha)
+    else:
+        gamma = transition_posterior(last_alpha[rows], A[rows], pred[A_idx[rows]], alpha[A_idx[rows]])
+    decay = ((1 - eps)**(t + 1 - touched[rows])).astype(S1.dtype)
+    En = En.at[rows].set(decay[:,np.newaxis] * En[rows] + gamma)
+    S1 = S1.at[rows].set(decay[:,np.newaxis] * S1[rows] + alpha[rows,np.newaxis] * obs_curr)
+    S2 = S2.at[rows].set(bcast(decay, S2) * S2[rows] + bcast(alpha[rows], S2) * outer_like(obs_curr, S2))
+    n_obs = (1 - eps)*n_obs + alpha
+    touched = touched.at[rows].set(t + 1)
+    return alpha, En, S1, S2, n_obs, touched
+
+def decayed(a, touched, t, eps, rows=slice(None)):
+    ## rows of a lazily decayed statistic as of step t
+    return a[rows] * bcast(((1 - eps)**(t - touched[rows])).astype(a.dtype), a)
+
 @jit
-def kill_dead_nodes(ind2, n_thresh, n_obs, S1, S2, En, log_A):
-    N = n_obs.shape[0]
-    d = S1.shape[1]
-    n_obs = n_obs.at[ind2].set(0)
-    S1 = S1.at[ind2].set(np.zeros(d))
-    S2 = S2.at[ind2].set(np.zeros((d,d)))
-    log_A = log_A.at[ind2].set(np.zeros(N))
-    log_A = log_A.at[:, ind2].set(np.zeros(N))
-    return n_obs, S1, S2, En, log_A
+def kill_dead_nodes(killed, S1, S2, log_A, A_idx=None):
+    ## clear the statistics of node killed; -1 leaves everything untouched
+    kill = killed >= 0
+    ind2 = np.maximum(killed, 0)
+    S1 = S1.at[ind2].set(np.where(kill, 0, S1[ind2]))
+    S2 = S2.at[ind2].set(np.where(kill, 0, S2[ind2]))
+    log_A = log_A.at[ind2].set(np.where(kill, 0, log_A[ind2]))
+    if A_idx is None:
+        log_A = log_A.at[:, ind2].set(np.where(kill, 0, log_A[:, ind2]))
+    else:
+        log_A = np.where(kill & (A_idx == ind2), 0, log_A)
+    return S1, S2, log_A
 
 @jit
-def log_pred_prob(B, A, alpha):
-    return np.log(alpha @ A @ np.exp(B) + 1e-16)
+def insert_transition(prev, node, log_A, A, A_idx, En, m_A, v_A):
+    ## top-k transitions: an observed prev -> node transition that is not kept replaces prev's weakest one
+    missing = ~np.any(A_idx[prev] == node)
+    slot = np.argmin(En[prev])
+    A_idx = A_idx.at[prev, slot].set(np.where(missing, node, A_idx[prev, slot]))
+    log_A = log_A.at[prev, slot].set(np.where(missing, np.mean(log_A[prev]), log_A[prev, slot]))
+    A = A.at[prev].set(np.where(missing, nn.softmax(log_A[prev]), A[prev]))
+    En, m_A, v_A = (a.at[prev, slot].set(np.where(missing, 0, a[prev, slot])) for a in (En, m_A, v_A))
+    return log_A, A, A_idx, En, m_A, v_A
+
+def teleport_node(x, mu, L, L_diag, alpha, n_obs, dead_order, dead_next, dead_nodes_ind, n_thresh):
+    ## no dead nodes left: zero the least observed node and kill the first one under n_thresh
+    no_dead = np.all(dead_order < 0)
+    target = np.argmin(n_obs)
+    n_obs = n_obs.at[target].set(np.where(no_dead, 0, n_obs[target]))
+
+    ma = (n_obs + dead_nodes_ind) < n_thresh
+    ind2 = np.argmax(ma)
+    kill = no_dead & np.any(ma)
+    n_obs = n_obs.at[ind2].set(np.where(kill, 0, n_obs[ind2]))
+    dead_order = dead_order.at[ind2].set(np.where(kill, dead_next, dead_order[ind2]))
+    dead_next = dead_next + kill
+    dead_nodes_ind = dead_nodes_ind.at[ind2].set(np.where(kill, n_thresh, dead_nodes_ind[ind2]))
+
+    ## pop the front of the dead-node queue and move it onto the data
+    node = np.argmin(np.where(dead_order < 0, np.iinfo(dead_order.dtype).max, dead_order))
+    mu = mu.at[node].set(x)
+    alpha = alpha.at[node].set(1)
+    dead_order = dead_order.at[node].set(-1)
+    dead_nodes_ind = dead_nodes_ind.at[node].set(0)
+
+    B = logB_all(x, mu, L, L_diag)
+    return B, mu, alpha, n_obs, dead_order, dead_next, dead_nodes_ind, node, np.where(kill, ind2, -1)
+
+@jit
+def update_B_nodes(x, B, mu, L, L_diag, alpha, n_obs, dead_order, dead_next, dead_nodes_ind, B_thresh, n_thresh):
+    ## teleport when no node explains x; node and killed are -1 when nothing happened.
+    ## The statistics of a killed node are cleared separately with kill_dead_nodes.
+    def keep():
+        no = np.array(-1, dtype=dead_order.dtype)
+        return B, mu, alpha, n_obs, dead_order, dead_next, dead_nodes_ind, no, no
+
+    def teleport():
+        out = teleport_node(x, mu, L, L_diag, alpha, n_obs, dead_order, dead_next, dead_nodes_ind, n_thresh)
+        return jax.tree.map(lambda new, old: new.astype(old.dtype), out, keep())
+
+    (B, mu, alpha, n_obs, dead_order, dead_next, dead_nodes_ind, node, killed) = lax.cond(np.max(B) < B_thresh, teleport, keep)
+    current_node = np.argmax(B)
+    return current_node, B, mu, alpha, n_obs, dead_order, dead_next, dead_nodes_ind, node, killed
 
-# @jit
-def pred_ahead(B, A, alpha, future_distance):
-    AT = np.linalg.matrix_power(A,future_distance)
-    return np.log(alpha @ AT @ np.exp(B) + 1e-16)
+@jit
+def log_pred_prob(B, A, alpha, A_idx=None):
+    ## log sum_j (alpha @ A)_j exp(B_j), in log space so it doesn't underflow for points far from every tile
+    return lse(B, b=propagate(alpha, A, A_idx))
+
+@jit
+def pred_ahead(B, A, alpha, future_distance, A_idx=None):
+    ## alpha @ A^future_distance as future_distance vector-matrix products, not a matrix power; future_distance
+    ## is traced, so one executable serves every distance
+    alpha = lax.fori_loop(0, future_distance, lambda _, a: propagate(a, A, A_idx), alpha)
+    return lse(B, b=alpha)
+
+@partial(jit, static_argnames=['horizons'])
+def forecast_nodes(A, alpha, horizons, A_idx=None):
+    ## (len(horizons), N) node probabilities alpha @ A^h for every h in horizons, all read off one pass of
+    ## max(horizons) propagations
+    def body(a, _):
+        a = propagate(a, A, A_idx)
+        return a, a
+    _, path = lax.scan(body, alpha, None, length=max(horizons))
+    return path[numpy.array(horizons) - 1]
+
+@partial(jit, static_argnames=['horizons'])
+def horizon_log_pred(future_x, A, alpha, mu, L, L_diag, horizons, A_idx=None):
+    ## log predictive probability of future_x h steps ahead for every h in horizons; a (len(horizons), d)
+    ## future_x has one point per horizon, a (d,) one is scored at every horizon
+    probs = forecast_nodes(A, alpha, horizons, A_idx)
+    if future_x.ndim == 1:
+        B = logB_all(future_x, mu, L, L_diag)[None]
+    else:
+        B = vmap(logB_all, in_axes=(0, None, None, None))(future_x, mu, L, L_diag)
+    return lse(B, b=probs, axis=1)
+
+@partial(jit, static_argnames=['horizon', 'chunk', 'posterior'])
+def query_points(X, mu, L, L_diag, n_obs, A, alpha, horizon=1, chunk=1024, A_idx=None, near=None, posterior=True):
+    ## for every row x of X (M, d): the log density of the tiling at x (nodes weighted by n_obs), the posterior
+    ## probability of each node given x under those weights, and the log predictive density of x horizon samples
+    ## after the last one (horizon=0: the current filtered distribution). Rows go through in chunks, so at most
+    ## (chunk, N, d) is live at a time. With near (M, k), row x is only evaluated against the nodes near[x];
+    ## posterior=False skips the (M, N) posteriors (None in their place)
+    log_w = np.log(n_obs + epsilon) - np.log(np.sum(n_obs + epsilon))
+    log_ahead = np.log(alpha if horizon == 0 else forecast_nodes(A, alpha, (horizon,), A_idx)[0])
+
+    def one(inputs):
+        x, near = inputs
+        if near is None:
+            B = logB_all(x, mu, L, L_diag)
+        else:
+            B = np.full(mu.shape[0], -np.inf).at[near].set(logB_all(x, mu[near], L[near], L_diag[near]))
+        joint = B + log_w
+        log_density = lse(joint)
+        return log_density, np.exp(joint - log_density) if posterior else None, lse(B + log_ahead)
+    return lax.map(one, (X, near), batch_size=chunk)
+
+@jit
+def entropy(A, alpha, A_idx=None):
+    ## in bits; nodes with no predicted mass add nothing, rather than 0 * log 0 = nan
+    one = propagate(alpha, A, A_idx)
+    return np.sum(entr(one)) / np.log(2)
+
+
+### Fused online step: the whole per-sample update over an immutable state pytree
+class BubblewrapState(NamedTuple):
+    mu: jax.Array
+    L: jax.Array
+    L_lower: jax.Array
+    L_diag: jax.Array
+    log_A: jax.Array
+    A: jax.Array
+    A_idx: jax.Array            # targets of the top-k transitions, None when A is dense
+    alpha: jax.Array
+    B: jax.Array
+    En: jax.Array
+    S1: jax.Array
+    S2: jax.Array
+    n_obs: jax.Array
+    touched: jax.Array          # with lazy_decay, row i of S1, S2 and En is stored as of step touched[i]
+    lam: jax.Array
+    mu_orig: jax.Array
+    sigma_orig: jax.Array
+    m_mu: jax.Array
+    m_L: jax.Array
+    m_L_diag: jax.Array
+    m_A: jax.Array
+    v_mu: jax.Array
+    v_L: jax.Array
+    v_L_diag: jax.Array
+    v_A: jax.Array
+    dead_order: jax.Array       # position of each node in the dead-node queue, -1 if alive
+    dead_next: jax.Array        # next free queue position
+    dead_nodes_ind: jax.Array
+    current_node: jax.Array
+    t: jax.Array
+    key: jax.Array
+    obs_mean: jax.Array
+    obs_cov: jax.Array
+    obs_n: jax.Array
+
+class BubblewrapParams(NamedTuple):
+    ## Hyperparameters, hashed as a static argument of the compiled step
+    eps: float
+    nu: float
+    step: float
+    B_thresh: float
+    n_thresh: float
+    go_fast: bool
+    future_distance: int
+    active_size: int = None
+    lazy_decay: bool = False
+    m_step: str = 'adam'
+    m_step_every: int = 1
+
+
+grad_all = vmap(grad(Q_j, argnums=(0,1,2,3)), in_axes=(0,0,0,0,0,0,0,0,0,None,None,None,None,0))
+
+def closed_form_node(mu, S1, lam, S2, n_obs, En, nu, sigma_orig, beta, mu_orig, fit_mu=True):
+    ## maximizer of Q_j for one node: the Normal-Inverse-Wishart MAP of mu and the precision
+    ## (as its Cholesky factor, like L_diag/L_lower) and the Dirichlet MAP of the transitions
+    d = mu.shape[0]
+    a = S1 + lam * mu_orig
+    if fit_mu:
+        mu = a / (lam + n_obs)
+    sigma = (sigma_orig + S2 + lam * np.outer(mu_orig, mu_orig) - np.outer(a, mu) - np.outer(mu, a)
+             + (lam + n_obs) * np.outer(mu, mu)) / (nu + n_obs + d + 2)
+    prec = np.linalg.inv(sigma)
+    L = np.linalg.cholesky((prec + prec.T) / 2)
+    return mu, np.tril(L, -1), np.log(np.diag(L) - epsilon), np.log(En + beta - 1)
+
+closed_form_all = vmap(closed_form_node, in_axes=(0,0,0,0,0,0,None,None,None,0,None))
+
+def grad_all_packed(mu, L_lower, L_diag, log_A, S1, lam, S2, n_obs, En, nu, sigma_orig, beta, d, mu_orig):
+    ## grad_all for packed L_lower and S2: both are unpacked going in and the L_lower gradient is packed
+    ## coming out, so differentiating never goes through the (slow) scatter that is the gradient of a gather
+    dim = mu.shape[1]
+    (grad_mu, grad_L, grad_L_diag, grad_A) = grad_all(mu, unpack(L_lower, dim, -1), L_diag, log_A, S1, lam, unpack(S2, dim, symmetric=True),
+                                                      n_obs, En, nu, sigma_orig, beta, d, mu_orig)
+    return grad_mu, pack(grad_L, -1), grad_L_diag, grad_A
+
+logB_all = vmap(single_logB, in_axes=(None,0,0,0))
+compute_L_all = vmap(get_L, (0,0))
+
+## compiled once per process for every model (see Bubblewrap.jit_functions)
+grad_all_jax = jit(grad_all)
+grad_all_packed_jax = jit(grad_all_packed)
+logB_jax = jit(logB_all)
+B_jax = jit(vmap(single_B, in_axes=(None,0,0,0)))
+compute_L_jax = jit(compute_L_all)
+invert_L_jax = jit(vmap(invert_l, 0))
+get_mus0 = jit(vmap(get_mus, 0))
 
 @jit
-def entropy(A, alpha):
-    AT = np.linalg.matrix_power(A,1)
-    one = alpha @ AT
-    return - np.sum(one.dot(np.log2(alpha @ AT)))
+def drift_prior(key, mu_orig, sigma_orig, mean, cov, n, nu):
+    ## prior means take a noisy step towards the data mean, and the prior covariance follows the data
+    ## covariance; both only once the covariance exists, from the third of n observations on
+    N, d = mu_orig.shape
+    lamr = 0.02
+    eta = np.sqrt(lamr * np.diag(cov))
+    key, subkey = random.split(key)
+    new_mu_orig = (1-lamr)*mu_orig + lamr*mean + eta*random.normal(subkey, (N, d), mu_orig.dtype)
+    new_sigma_orig = cov * (nu + d + 1) / (N**(2/d))
+
+    ## the data statistics may be wider than the model (a float32 model under x64)
+    drift = n > 2
+    return (key, np.where(drift, new_mu_orig, mu_orig).astype(mu_orig.dtype),
+            np.where(drift, new_sigma_orig, sigma_orig).astype(sigma_orig.dtype))
+
+def observe_state(state, x, params):
+    ## Running mean/covariance of the data and drift of the prior means; x is one sample or a (b, d) block
+    if params.go_fast:
+        return state
+
+    X = x.reshape(-1, x.shape[-1])
+    n = state.obs_n + X.shape[0]
+    mean, cov = welford_update(state.obs_mean, state.obs_cov, state.obs_n, X)
+
+    key, mu_orig, sigma_orig = drift_prior(state.key, state.mu_orig, state.sigma_orig, mean, cov, n, params.nu)
+    return state._replace(obs_n=n, obs_mean=mean, obs_cov=cov, key=key, mu_orig=mu_orig, sigma_orig=sigma_orig)
+
+def active_nodes(alpha, A, A_idx, current_node, m):
+    ## the m nodes with the most mass now or one step ahead (alpha + alpha @ A), always including current_node
+    score = alpha + propagate(alpha, A, A_idx)
+    score = score.at[current_node].set(np.inf)
+    return lax.top_k(score, m)[1]
+
+def active_logB(x, mu, L, L_diag, alpha, A, A_idx, current_node, params):
+    ## logB over the active nodes only, -inf elsewhere. When none of them explains x every node is
+    ## scored, so the teleport decision in update_B_nodes is the same as without an active set.
+    if params.active_size is None:
+        return logB_all(x, mu, L, L_diag)
+    act = active_nodes(alpha, A, A_idx, current_node, params.active_size)
+    B = np.full(mu.shape[0], -np.inf, mu.dtype).at[act].set(logB_all(x, mu[act], L[act], L_diag[act]))
+    return lax.cond(np.max(B) < params.B_thresh, lambda: logB_all(x, mu, L, L_diag), lambda: B)
+
+def e_step_metrics(B, A, A_idx, alpha, mu, L, L_diag, future_x, params):
+    ## (log_pred, entropy, pred_far) before x is absorbed; nan when skipped
+    if params.go_fast:
+        return (np.nan, np.nan, np.nan)
+
+    new_log_pred = log_pred_prob(B, A, alpha, A_idx)
+    ent = entropy(A, alpha, A_idx)
+    pred_far = np.nan
+    if future_x is not None:
+        future_B = logB_all(future_x, mu, L, L_diag)
+        pred_far = pred_ahead(future_B, A, alpha, params.future_distance, A_idx)
+    return (new_log_pred, ent, pred_far)
+
+def e_step_state(state, x, future_x, params):
+    ## x is one sample or a (b, d) block
+    if x.ndim == 2:
+        return batch_e_step_state(state, x, future_x, params)
+
+    B = active_logB(x, state.mu, state.L, state.L_diag, state.alpha, state.A, state.A_idx, state.current_node, params)
+    metrics = e_step_metrics(B, state.A, state.A_idx, state.alpha, state.mu, state.L, state.L_diag, future_x, params)
+
+    (current_node, B, mu, alpha, n_obs, dead_order, dead_next, dead_nodes_ind, _, killed) = update_B_nodes(
+        x, B, state.mu, state.L, state.L_diag, state.alpha, state.n_obs,
+        state.dead_order, state.dead_next, state.dead_nodes_ind, params.B_thresh, params.n_thresh)
+    S1, S2, log_A = kill_dead_nodes(killed, state.S1, state.S2, state.log_A, state.A_idx)
+
+    A, A_idx, En, m_A, v_A = state.A, state.A_idx, state.En, state.m_A, state.v_A
+    if A_idx is not None:
+        log_A, A, A_idx, En, m_A, v_A = insert_transition(state.current_node, current_node, log_A, A, A_idx, En, m_A, v_A)
+
+    touched = state.touched
+    if params.lazy_decay:
+        alpha, En, S1, S2, n_obs, touched = lazy_update_internal(A, B, alpha, En, params.eps, S1, x, S2, n_obs, touched, state.t, params.active_size, A_idx)
+    else:
+        gamma, alpha, En, S1, S2, n_obs = update_internal(A, B, alpha, En, params.eps, S1, x, S2, n_obs, A_idx)
+    state = state._replace(B=B, current_node=current_node, mu=mu, alpha=alpha, En=En, S1=S1, S2=S2, n_obs=n_obs, touched=touched, log_A=log_A,
+                           A=A, A_idx=A_idx, m_A=m_A, v_A=v_A,
+                           dead_order=dead_order, dead_next=dead_next, dead_nodes_ind=dead_nodes_ind, t=state.t+1)
+    return state, metrics
+
+def batch_e_step_state(state, X, future_x, params):
+    ## Forward recursion of update_internal over a (b, d) block in one scan. Only the N-sized quantities
+    ## (alpha, n_obs, teleports) are carried; S1, S2 and En get the whole block afterwards as one
+    ## weighted contraction, with sample t weighted by (1-eps)^(b-1-t). Top-k transitions are only
+    ## (N, k), so they and their En are updated inside the scan.
+    b, d = X.shape
+    N = state.mu.shape[0]
+    L, L_diag, eps = state.L, state.L_diag, params.eps
+    if params.lazy_decay:
+        state = materialize_state(state, params)
+    sparse = state.A_idx is not None
+
+    def body(carry, x):
+        mu, alpha, n_obs, dead_order, dead_next, dead_nodes_ind, killed_at, i, trans = carry
+        log_A, A, A_idx, En, m_A, v_A, prev = trans
+
+        B = active_logB(x, mu, L, L_diag, alpha, A, A_idx, prev, params)
+        metrics = e_step_metrics(B, A, A_idx, alpha, mu, L, L_diag, future_x, params)
+
+        (current_node, B, mu, alpha, n_obs, dead_order, dead_next, dead_nodes_ind, _, killed) = update_B_nodes(
+            x, B, mu, L, L_diag, alpha, n_obs, dead_order, dead_next, dead_nodes_ind, params.B_thresh, params.n_thresh)
+        ind2 = np.maximum(killed, 0)
+        killed_at = killed_at.at[ind2].set(np.where(killed >= 0, i, killed_at[ind2]))
+
+        last_alpha = alpha
+        if sparse:
+            kill = (killed >= 0) & ((np.arange(N)[:, None] == ind2) | (A_idx == ind2))
+            log_A = np.where(kill, 0, log_A)
+            log_A, A, A_idx, En, m_A, v_A = insert_transition(prev, current_node, log_A, A, A_idx, En, m_A, v_A)
+        pred = propagate(last_alpha, A, A_idx)
+        alpha, log_norm = forward_alpha(pred, B)
+        if sparse:
+            En = transition_posterior(last_alpha, A, pred[A_idx], alpha[A_idx]) + (1 - eps)*En
+        n_obs = (1 - eps)*n_obs + alpha
+
+        ## log(alpha_j / pred_j), the per-step column factor of the dense transition posterior
+        log_ratio = np.where(pred > 0, B - log_norm, -np.inf)
+        trans = (log_A, A, A_idx, En, m_A, v_A, current_node.astype(prev.dtype))
+        carry = (mu, alpha, n_obs, dead_order, dead_next, dead_nodes_ind, killed_at, i+1, trans)
+        return carry, (last_alpha, B, log_ratio, alpha, current_node, metrics)
+
+    trans = (state.log_A, state.A, state.A_idx, state.En, state.m_A, state.v_A, state.current_node)
+    carry = (state.mu, state.alpha, state.n_obs, state.dead_order, state.dead_next, state.dead_nodes_ind,
+             -np.ones(N, dtype=state.dead_order.dtype), 0, trans)
+    carry, (last_alphas, Bs, log_ratios, alphas, current_nodes, metrics) = lax.scan(body, carry, X)
+    mu, alpha, n_obs, dead_order, dead_next, dead_nodes_ind, killed_at, _, trans = carry
+    log_A, A, A_idx, En, m_A, v_A, _ = trans
+
+    ## a node killed at step k loses everything it had gathered before k
+    steps = np.arange(b)
+    w = ((1 - eps)**(b - 1 - steps)).astype(X.dtype)
+    decay = (1 - eps)**b
+    alive = killed_at < 0
+    kept = steps[:, None] >= killed_at[None, :]
+    aw = alphas * w[:, None] * kept
+
+    S1 = np.where(alive[:, None], decay*state.S1, 0) + aw.T @ X
+    XX = vmap(outer_like, (0, None))(X, state.S2).reshape(b, -1)
+    S2 = np.where(bcast(alive, state.S2), decay*state.S2, 0) + (aw.T @ XX).reshape(state.S2.shape)
+    if not sparse:
+        ## sum_t w_t last_alpha_ti A_ij exp(log_ratio_tj), with each column's largest ratio factored out of the
+        ## contraction. Putting it back only goes through log space when exp(top) itself would overflow, i.e.
+        ## when some node had next to no predicted mass.
+        top = np.max(log_ratios, axis=0)
+        top = np.where(np.isfinite(top), top, 0)
+        summed = (last_alphas * w[:, None]).T @ np.exp(log_ratios - top)
+        scale = np.exp(top)
+        En = decay*state.En + lax.cond(np.all(np.isfinite(scale)), lambda: A * summed * scale,
+                                       lambda: np.exp(np.log(A) + top + np.log(summed)))
+        log_A = np.where(alive[:, None] & alive[None, :], state.log_A, 0)
+
+    state = state._replace(B=Bs[-1], current_node=current_nodes[-1], mu=mu, alpha=alpha, En=En, S1=S1, S2=S2, n_obs=n_obs,
+                           log_A=log_A, A=A, A_idx=A_idx, m_A=m_A, v_A=v_A,
+                           dead_order=dead_order, dead_next=dead_next, dead_nodes_ind=dead_nodes_ind,
+                           touched=np.full_like(state.touched, state.t+b), t=state.t+b)
+    return state, metrics
+
+e_step_jax = jit(e_step_state, static_argnames=('params',))
+
+def materialize_state(state, params):
+    ## every row of the lazily decayed S1, S2 and En brought up to step t
+    touched = state.touched
+    return state._replace(S1=decayed(state.S1, touched, state.t, params.eps), S2=decayed(state.S2, touched, state.t, params.eps),
+                          En=decayed(state.En, touched, state.t, params.eps), touched=np.full_like(touched, state.t))
+
+def grad_Q_state(state, params, mode='fit'):
+    ## with an active set only those nodes get an M-step; the others keep their parameters
+    ## and Adam moments, while their statistics still decay in the E-step
+    d = state.mu.shape[1]
+    beta = 1 + 10/state.t
+
+    if params.active_size is None:
+        take = lambda a: a
+        put = lambda a, new: new
+    else:
+        act = active_nodes(state.alpha, state.A, state.A_idx, state.current_node, params.active_size)
+        take = lambda a: a[act]
+        put = lambda a, new: a.at[act].set(new)
+    ## the sufficient statistics of the rows being read, decayed to now when stored lazily
+    stat = (lambda a: decayed(a, state.touched, state.t, params.eps, act)) if params.lazy_decay else take
+
+    if params.m_step == 'closed_form':
+        S2 = stat(state.S2)
+        if S2.ndim == 2:
+            S2 = unpack(S2, d, symmetric=True)
+        mu, L_lower, L_diag, log_A = closed_form_all(take(state.mu), stat(state.S1), take(state.lam), S2, take(state.n_obs), stat(state.En),
+                                                     params.nu, state.sigma_orig, beta, take(state.mu_orig), mode == 'fit')
+        if state.L_lower.ndim == 2:
+            L_lower = pack(L_lower, -1)
+        mu, L_lower, L_diag, log_A = put(state.mu, mu), put(state.L_lower, L_lower), put(state.L_diag, L_diag), put(state.log_A, log_A)
+        return state._replace(mu=mu, L_lower=L_lower, L_diag=L_diag, log_A=log_A, A=put(state.A, sm(take(log_A))),
+                              L=put(state.L, compute_L_all(take(L_diag), take(L_lower))))
+
+    if params.lazy_decay:
+        divisor = 1 + ((1 - params.eps)**(state.t - state.touched)).astype(state.En.dtype).dot(np.sum(state.En, axis=1))
+    else:
+        divisor = 1+sum_me(state.En)
+
+    grad_fn = grad_all_packed if state.S2.ndim == 2 else grad_all
+    (grad_mu, grad_L, grad_L_diag, grad_A) = grad_fn(take(state.mu), take(state.L_lower), take(state.L_diag), take(state.log_A), stat(state.S1), take(state.lam), stat(state.S2), take(state.n_obs), stat(state.En), params.nu, state.sigma_orig, beta, d, take(state.mu_orig))
+
+    def adam(m, v, grad, val):
+        m_new, v_new, val_new = single_adam(params.step, take(m), take(v), grad/divisor, state.t, take(val))
+        return put(m, m_new), put(v, v_new), put(val, val_new)
+
+    mu, m_mu, v_mu = state.mu, state.m_mu, state.v_mu
+    if mode == 'fit':
+        m_mu, v_mu, mu = adam(m_mu, v_mu, grad_mu, mu)
+    m_L, v_L, L_lower = adam(state.m_L, state.v_L, grad_L, state.L_lower)
+    m_L_diag, v_L_diag, L_diag = adam(state.m_L_diag, state.v_L_diag, grad_L_diag, state.L_diag)
+    m_A, v_A, log_A = adam(state.m_A, state.v_A, grad_A, state.log_A)
+
+    return state._replace(mu=mu, L_lower=L_lower, L_diag=L_diag, log_A=log_A, A=put(state.A, sm(take(log_A))), L=put(state.L, compute_L_all(take(L_diag), take(L_lower))),
+                          m_mu=m_mu, v_mu=v_mu, m_L=m_L, v_L=v_L, m_L_diag=m_L_diag, v_L_diag=v_L_diag, m_A=m_A, v_A=v_A)
+
+grad_Q_jax = jit(grad_Q_state, static_argnames=('params', 'mode'))
+
+## the fields written by the M-step, swapped in from the background learner: per-node parameters with their
+## Adam moments, and the transitions
+node_fields = ('mu', 'L', 'L_lower', 'L_diag', 'm_mu', 'm_L', 'm_L_diag', 'v_mu', 'v_L', 'v_L_diag')
+transition_fields = ('log_A', 'm_A', 'v_A')
+
+@jit
+def merge_learned(state, snapshot, learned):
+    ## the M-step run on snapshot, except where the E-step has changed the model since. What to keep is decided
+    ## once and applied to each parameter and its moments together: nodes whose mean moved (teleports) keep all
+    ## their current parameters, and the transitions the E-step wrote (of killed nodes, or inserted top-k ones)
+    ## keep their current log_A, m_A and v_A. Rows of A with a kept transition are renormalized from the merged log_A.
+    moved = np.any(state.mu != snapshot.mu, axis=1)
+    died = (snapshot.dead_order < 0) & (state.dead_order >= 0)
+    written = (state.log_A != snapshot.log_A) | died[:, np.newaxis]
+    if state.A_idx is None:
+        written = written | died
+    else:
+        written = written | (state.A_idx != snapshot.A_idx) | died[state.A_idx]
+
+    def merge(keep, now, new):
+        return np.where(keep, now, new.astype(now.dtype))
+    merged = {k: merge(bcast(moved, getattr(state, k)), getattr(state, k), getattr(learned, k)) for k in node_fields}
+    merged.update({k: merge(written, getattr(state, k), getattr(learned, k)) for k in transition_fields})
+    A = np.where(np.any(written, axis=1)[:, np.newaxis], sm(merged['log_A']), learned.A)
+    return state._replace(A=A.astype(state.A.dtype), **merged)
+
+@partial(jit, static_argnames=('params', 'mode'))
+def fused_step(state, x, future_x, params, mode='fit', m_step_due=None):
+    ## returns the new state and (log_pred, entropy, pred_far); metrics are nan when skipped.
+    ## x is one sample or, in batch mode, a (b, d) block with one metric per row.
+    ## m_step_due overrides the every-m_step_every schedule (see scheduled_m_step)
+    t = state.t
+    state = observe_state(state, x, params)
+    state, metrics = e_step_state(state, x, future_x, params)
+    state = scheduled_m_step(state, t, params, mode, m_step_due)
+    return state, metrics
+
+def scheduled_m_step(state, t, params, mode='fit', due=None):
+    ## grad_Q_state if due; by default when the samples since step t complete a multiple of m_step_every
+    if due is None:
+        if params.m_step_every == 1:
+            return grad_Q_state(state, params, mode)
+        due = state.t // params.m_step_every > t // params.m_step_every
+
+    def m_step(state):
+        new = grad_Q_state(state, params, mode)
+        return jax.tree.map(lambda new, old: new.astype(old.dtype), new, state)
+
+    return lax.cond(due, m_step, lambda state: state, state)
+
+@partial(jit, static_argnames=('params', 'mode'), donate_argnames=('ring',))
+def recorded_step(state, ring, pos, x, future_x, params, mode='fit', m_step_due=None):
+    ## fused_step also writing its (log_pred, entropy, pred_far) into row pos of the device ring buffer
+    state, metrics = fused_step(state, x, future_x, params, mode, m_step_due)
+    return state, ring.at[pos].set(np.stack(metrics).astype(ring.dtype))
+
+@partial(jit, static_argnames=('params', 'mode'))
+def fit_stream_state(state, data, future_data, has_future, params, mode='fit'):
+    ## fused_step scanned over a whole recording; pred_far is nan where there is no future sample
+    def body(state, inputs):
+        x, future_x, valid = inputs
+        new_state, (new_log_pred, ent, pred_far) = fused_step(state, x, future_x, params, mode)
+        ## the carry must keep its dtypes, e.g. a float32 sigma_orig from init_nodes under x64
+        new_state = jax.tree.map(lambda new, old: new.astype(old.dtype), new_state, state)
+        return new_state, (new_log_pred, ent, np.where(valid, pred_far, np.nan))
+
+    return lax.scan(body, state, (data, future_data, has_future))
+
+@partial(jit, static_argnames=('params', 'mode'))
+def ensemble_step(states, X, future_X, params, mode='fit'):
+    ## fused_step vmapped over independent models; every leaf of states has a leading stream axis
+    return vmap(lambda state, x, future_x: fused_step(state, x, future_x, params, mode))(states, X, future_X)
+
+@partial(jit, static_argnames=('n_clusters', 'iters', 'batch'))
+def minibatch_kmeans(key, X, n_clusters, iters=50, batch=1024):
+    ## n_clusters centers of the rows of X by mini-batch k-means (Sculley, 2010): start from distinct random
+    ## rows, then each step assigns a random batch to its nearest centers and moves every center towards the
+    ## mean of its points with step 1/(points it has seen so far). Costs iters * batch * n_clusters * d,
+    ## independent of the number of rows.
+    M = X.shape[0]
+    key, sub = random.split(key)
+    centers = X[random.choice(sub, M, (n_clusters,), replace=False)]
+    counts = np.zeros(n_clusters, dtype=X.dtype)
+
+    def body(_, carry):
+        centers, counts, key = carry
+        key, sub = random.split(key)
+        Xb = X[random.randint(sub, (min(batch, M),), 0, M)]
+        nearest = np.argmin(np.sum(centers**2, axis=1) - 2 * Xb @ centers.T, axis=1)
+        sums = jax.ops.segment_sum(Xb, nearest, n_clusters)
+        seen = jax.ops.segment_sum(np.ones(Xb.shape[0], X.dtype), nearest, n_clusters)
+        counts = counts + seen
+        centers = centers + (sums - seen[:,np.newaxis] * centers) / np.maximum(counts, 1)[:,np.newaxis]
+        return centers, counts, key
+
+    centers, _, _ = lax.fori_loop(0, iters, body, (centers, counts, key))
+    return centers
+
+def load_tiling(source):
+    ## numpy arrays mu, L, A, n_obs (and A_idx for top-k transitions) of a saved tiling: a Bubblewrap, a
+    ## save_state file, an .npz archive or any mapping with those keys
+    if isinstance(source, Bubblewrap):
+        source.materialize()
+        source = {'mu': source.mu, 'L': source.L, 'A': source.A, 'A_idx': source.A_idx, 'n_obs': source.n_obs}
+    elif isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, 'rb') as f:
+            magic = f.read(len(checkpoint_magic))
+        source = read_checkpoint(source)[1] if magic == checkpoint_magic else numpy.load(source)
+    tiling = {k: numpy.array(source[k], dtype=float) for k in ['mu', 'L', 'A', 'n_obs']}
+    if 'A_idx' in source and source['A_idx'] is not None:
+        tiling['A_idx'] = numpy.array(source['A_idx'], dtype=int)
+    return tiling
+
+def mixture_cov(mu, L, n_obs):
+    ## covariance of the n_obs-weighted mixture of the tiles N(mu_j, (L_j L_j^T)^-1)
+    w = (n_obs + 1e-16) / numpy.sum(n_obs + 1e-16)
+    inv = numpy.linalg.inv(L)
+    sigma = numpy.swapaxes(inv, 1, 2) @ inv
+    mean = w @ mu
+    return numpy.einsum('n,nij->ij', w, sigma) + (mu - mean).T @ (w[:,None] * (mu - mean))
+
+def warm_start_transitions(log_A, A_idx, A0, A0_idx, transition_k):
+    ## log_A (and A_idx) of a new model with the saved transitions A0 written into its first N0 rows. Dense
+    ## targets get the saved probabilities, with the columns of nodes past N0 near zero; top-k targets keep
+    ## the k most likely saved transitions of each node.
+    N0 = A0.shape[0]
+    log_A = log_A.copy()
+    if transition_k is None:
+        A = numpy.zeros((N0, log_A.shape[1]))
+        if A0_idx is None:
+            A[:, :N0] = A0
+        else:
+            numpy.put_along_axis(A, A0_idx, A0, axis=1)
+        log_A[:N0] = numpy.log(A + epsilon)
+        return log_A, A_idx
+
+    if A0.shape[1] < transition_k:
+        raise ValueError(f"the saved tiling keeps {A0.shape[1]} transitions per node, fewer than transition_k={transition_k}")
+    if A0_idx is None:
+        A0_idx = numpy.broadcast_to(numpy.arange(N0), A0.shape)
+    top = numpy.argsort(-A0, axis=1, kind='stable')[:, :transition_k]
+    A_idx = numpy.array(A_idx)
+    A_idx[:N0] = numpy.take_along_axis(A0_idx, top, axis=1)
+    log_A[:N0] = numpy.log(numpy.take_along_axis(A0, top, axis=1) + epsilon)
+    return log_A, A_idx
 
 def center_mass(points):
     return numpy.mean(points, axis=0)
 
+class MetricBuffer:
+    ## History of a per-step metric. Appended values stay on device until `chunk` of them have
+    ## accumulated, which then go to the host in one transfer; with maxlen only the most recent
+    ## maxlen values are kept. Reads like a NumPy array (np.asarray, len, slicing, iteration).
+    def __init__(self, maxlen=None, chunk=1024, before_read=None):
+        self.maxlen = maxlen
+        self.chunk = chunk
+        self.before_read = before_read  # e.g. moves values recorded elsewhere in with store()
+        self.pending = []           # values not yet on the host
+        self.chunks = deque()       # host blocks, oldest first
+        self.stored = 0             # values in chunks
+
+    def append(self, x):
+        self.pending.append(x)
+        if len(self.pending) >= self.chunk:
+            self.flush()
+
+    def extend(self, xs):
+        ## a whole block of values at once, e.g. the stacked metrics of a batch or a scan
+        self.store(numpy.asarray(xs))
+
+    def flush(self):
+        if self.pending:
+            if any(isinstance(v, jax.Array) for v in self.pending):
+                ## stacked on device first, so the block is one device-to-host copy rather than one per value
+                block = numpy.asarray(np.stack(self.pending))
+            else:
+                block = numpy.array(self.pending)
+            self.pending = []
+            self.store(block)
+
+    def store(self, block):
+        ## host block of values appended after everything kept so far
+        if self.pending:
+            self.flush()
+        self.chunks.append(block)
+        self.stored += len(block)
+        if self.maxlen is not None:
+            while self.stored - len(self.chunks[0]) >= self.maxlen:
+                self.stored -= len(self.chunks.popleft())
+
+    def numpy(self):
+        ## everything kept so far as one host array; later reads reuse it
+        if self.before_read is not None:
+            self.before_read()
+        self.flush()
+        if not self.chunks:
+            return numpy.zeros(0)
+        values = numpy.concatenate(self.chunks)
+        if self.maxlen is not None:
+            values = values[-self.maxlen:]
+        self.chunks = deque([values])
+        self.stored = len(values)
+        return values
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.numpy()
+        return values if dtype is None else values.astype(dtype)
+
+    def __len__(self):
+        if self.before_read is not None:
+            self.before_read()
+        n = self.stored + len(self.pending)
+        return n if self.maxlen is None else min(n, self.maxlen)
+
+    def __getitem__(self, ind):
+        return self.numpy()[ind]
+
+    def __iter__(self):
+        return iter(self.numpy())
+
+
+class TileIndex:
+    ## Spatial index over the tiles for density queries, built from host copies of mu, L, L_diag and n_obs.
+    ## Centers are put in coordinates z = x @ W whitened by the mean precision of the tiles (W W^T = mean of
+    ## L_j L_j^T). There the weighted density of tile j, log w_j + logB_j with w ~ n_obs as in query_points, is
+    ## peak[j] - |(z - z_j) @ L_z[j]|^2 / 2, at most peak[j] - s[j]^2 |z - z_j|^2 / 2, which is close to it
+    ## when the tiles have similar shapes. Tiles are grouped into one KD-tree per power of two of s and band
+    ## of peak, so that within a group this bound falls off with distance at nearly the same rate from nearly
+    ## the same height.
+    def __init__(self, mu, L, L_diag, n_obs, band=10):
+        N, d = mu.shape
+        w = (n_obs + epsilon) / numpy.sum(n_obs + epsilon)
+        var, vecs = numpy.linalg.eigh(numpy.mean(L @ L.transpose(0, 2, 1), axis=0))
+        self.whiten = vecs * numpy.sqrt(var)
+        self.z = mu @ self.whiten
+
+        ## (x - mu_j) @ L_j = (z - z_j) @ W^-1 L_j; with the largest singular value of W^-1 L_j for s in the
+        ## bound instead of the smallest, it is a lower bound
+        self.L_z = numpy.linalg.solve(self.whiten, L)
+        sv = numpy.linalg.svd(self.L_z, compute_uv=False)
+        self.s, self.s_max = sv[:, -1] + epsilon, sv[:, 0]
+        self.peak = numpy.log(w) + numpy.sum(L_diag, axis=1) - (d/2) * numpy.log(2*numpy.pi)
+
+        group = numpy.stack([numpy.floor(numpy.log2(self.s)), numpy.floor(self.peak / band)], axis=1)
+        self.groups = []
+        ## highest peaks first, where the densest tile at a point is usually found
+        for g in sorted(numpy.unique(group, axis=0), key=lambda g: -g[1]):
+            nodes = numpy.flatnonzero(numpy.all(group == g, axis=1))
+            self.groups.append((nodes, cKDTree(self.z[nodes]), self.peak[nodes].max(), self.s[nodes].min()))
+
+    def score(self, z, j):
+        ## weighted density of tile j[p] at row p of z (P, d), a tile at a time
+        out = numpy.empty(len(j))
+        order = numpy.argsort(j, kind='stable')
+        bounds = numpy.searchsorted(j[order], numpy.arange(len(self.z) + 1))
+        for t in numpy.flatnonzero(bounds[1:] > bounds[:-1]):
+            p = order[bounds[t]:bounds[t+1]]
+            v = (z[p] - self.z[t]) @ self.L_z[t]
+            out[p] = self.peak[t] - numpy.sum(v**2, axis=1) / 2
+        return out
+
+    def candidates(self, X, k, depth=30, chunk=4096):
+        ## (M, k) tiles at each row of X (M, d): the ones with the highest weighted density among those within
+        ## depth nats of the densest tile there, padded with the densest when there are fewer. A lower bound at
+        ## the nearest tile of every group gives a first level at or below that cut; then, group by group, only
+        ## tiles within the radius where the group's bound still reaches the level are scored, and the densest
+        ## so far raises it. Rows are taken chunk at a time.
+        z = numpy.asarray(X) @ self.whiten
+        near = numpy.zeros((len(z), k), dtype=int)
+        for c in range(0, len(z), chunk):
+            zc = z[c:c+chunk]
+            best = numpy.full(len(zc), -numpy.inf)
+            for nodes, tree, _, _ in self.groups:
+                dist, i = tree.query(zc, k=1)
+                best = numpy.maximum(best, self.peak[nodes[i]] - (self.s_max[nodes[i]] * dist)**2 / 2)
+            level = best - depth
+
+            ## (row, tile) pairs within reach and their densities, gathered over the groups
+            pair_row, pair_j, pair_b = [], [], []
+            for nodes, tree, peak_max, s_min in self.groups:
+                rows = numpy.flatnonzero(peak_max >= level)
+                ## with a little slack, so that rounding doesn't drop the tiles that set the level
+                reach = numpy.sqrt(2 * (peak_max - level[rows])) / s_min * (1 + 1e-6) + 1e-9
+                found = tree.query_ball_point(zc[rows], reach)
+                r = numpy.repeat(rows, numpy.fromiter(map(len, found), dtype=int, count=len(rows)))
+                j = nodes[numpy.fromiter(itertools.chain.from_iterable(found), dtype=int, count=len(r))]
+                b = self.score(zc[r], j)
+                numpy.maximum.at(best, r, b)
+                level = numpy.maximum(level, best - depth)
+                pair_row.append(r)
+                pair_j.append(j)
+                pair_b.append(b)
+            pair_row, pair_j, pair_b = numpy.concatenate(pair_row), numpy.concatenate(pair_j), numpy.concatenate(pair_b)
+
+            ## the densest tile of every row is among its pairs, and leads them after sorting
+            order = numpy.lexsort((-pair_b, pair_row))
+            pair_row, pair_j, pair_b = pair_row[order], pair_j[order], pair_b[order]
+            start = numpy.searchsorted(pair_row, numpy.arange(len(zc)))
+            end = numpy.append(start[1:], len(pair_row))
+            pick = start[:, numpy.newaxis] + numpy.arange(k)
+            keep = pick < end[:, numpy.newaxis]
+            pick = numpy.where(keep, pick, start[:, numpy.newaxis])
+            keep &= pair_b[pick] >= pair_b[start][:, numpy.newaxis] - depth
+            near[c:c+chunk] = numpy.where(keep, pair_j[pick], pair_j[start][:, numpy.newaxis])
+        return near
+
+
+checkpoint_magic = b'BUBBLEWRAP'
+checkpoint_version = 1
+
+def write_checkpoint(path, header, arrays, stored=None):
+    ## One file: magic, format version, length of a JSON header, the header, then every array as raw bytes at a
+    ## 64-byte aligned offset, so read_checkpoint can memory-map them. The header lists the name, dtype, shape and
+    ## offset of each array; stored maps names to a dtype to store them at instead (cast back on load)
+    stored = stored or {}
+    layout, offset = {}, 0
+    for name, a in arrays.items():
+        a = numpy.asarray(a)
+        layout[name] = {'dtype': a.dtype.str, 'stored': numpy.dtype(stored.get(name, a.dtype)).str,
+                        'shape': list(a.shape), 'offset': offset}
+        offset += -(-a.size * numpy.dtype(layout[name]['stored']).itemsize // 64) * 64
+    head = json.dumps(dict(header, arrays=layout)).encode()
+    start = -(-(len(checkpoint_magic) + 12 + len(head)) // 64) * 64
+
+    with open(path, 'wb') as f:
+        f.write(checkpoint_magic + numpy.uint32(checkpoint_version).tobytes() + numpy.uint64(len(head)).tobytes() + head)
+        for name, a in arrays.items():
+            a = numpy.asarray(a)
+            b = numpy.ascontiguousarray(a, dtype=layout[name]['stored'])
+            if b.dtype.kind == 'f' and numpy.any(numpy.isinf(b) & ~numpy.isinf(a)):
+                raise ValueError(f"{name} overflows {b.dtype}; store it at a wider precision")
+            f.seek(start + layout[name]['offset'])
+            f.write(b.tobytes())
+        f.truncate(start + offset)
+
+def read_checkpoint(path):
+    ## (header, arrays) of a write_checkpoint file; arrays stored at their own dtype are read-only memory maps
+    with open(path, 'rb') as f:
+        magic = f.read(len(checkpoint_magic))
+        if magic != checkpoint_magic:
+            raise ValueError(f"{path} is not a Bubblewrap checkpoint")
+        version = int(numpy.frombuffer(f.read(4), numpy.uint32)[0])
+        if version != checkpoint_version:
+            raise ValueError(f"{path} has checkpoint format version {version}, this code reads version {checkpoint_version}")
+        length = int(numpy.frombuffer(f.read(8), numpy.uint64)[0])
+        head = json.loads(f.read(length))
+    start = -(-(len(checkpoint_magic) + 12 + length) // 64) * 64
+
+    arrays = {}
+    for name, a in head.pop('arrays').items():
+        if numpy.prod(a['shape']) == 0:
+            arrays[name] = numpy.zeros(a['shape'], dtype=a['dtype'])
+            continue
+        m = numpy.memmap(path, dtype=a['stored'], mode='r', offset=start + a['offset'], shape=tuple(a['shape']))
+        arrays[name] = m if a['stored'] == a['dtype'] else m.astype(a['dtype'])
+    return head, arrays
+
+
 class Observations:
     def __init__(self, dim, M=5, go_fast=True):
         self.M = M  # how many observed points to hold in memory
@@ -461,42 +1888,61 @@ class Observations:
         self.go_fast = go_fast
 
         self.curr = None 
-        self.saved_obs = deque(maxlen=self.M)
+        ## the last M observations in a preallocated circular array; once full, rows pos: come before rows :pos
+        self.buffer = numpy.zeros((self.M, self.d))
+        self.pos = 0
+        self.count = 0
 
+        ## running biased mean and covariance of every observation so far (not tracked when going fast)
         self.mean = None
-        self.last_mean = None
-
         self.cov = None
         
         self.n_obs = 0
 
+    @property
+    def saved_obs(self):
+        ## (min(n_obs, M), d) array of the last observations, oldest first; a view of the buffer unless
+        ## single samples have wrapped around it (blocks of M or more rows are stored aligned)
+        if self.count < self.M:
+            return self.buffer[:self.count]
+        if self.pos == 0:
+            return self.buffer
+        return numpy.concatenate([self.buffer[self.pos:], self.buffer[:self.pos]])
+
+    def store(self, block):
+        ## write the rows of a (b, d) block into the circular array; n_obs is counted by the caller
+        block = numpy.asarray(block).reshape(-1, self.d)
+        b = block.shape[0]
+        if b >= self.M:
+            self.buffer[:] = block[-self.M:]
+            self.pos = 0
+        else:
+            self.buffer[(self.pos + numpy.arange(b)) % self.M] = block
+            self.pos = (self.pos + b) % self.M
+        self.count = min(self.count + b, self.M)
+        self.curr = block[-1]
+
     def new_obs(self, coord_new):
-        self.curr = coord_new
-        self.saved_obs.append(self.curr)
-        self.n_obs += 1
-       
+        ## one sample, as (d,) or as a (1, d) slice
+        self.new_obs_batch(numpy.asarray(coord_new).reshape(-1, self.d))
+
+    def new_obs_batch(self, block):
+        ## every row of a (b, d) block, with the running statistics merged in one welford_update
         if not self.go_fast:
-            if self.mean is None:
-                self.mean = self.curr.copy()
-            else:
-                self.last_mean = self.mean.copy()
-                self.mean = update_mean(self.mean, self.curr, self.n_obs)
-                
-            if self.n_obs > 2:
-                if self.cov is None:
-                    self.cov = np.cov(np.array(self.saved_obs).T, bias=True)
-                else:
-                    self.cov = update_cov(self.cov, self.last_mean, self.curr, self.mean, self.n_obs)
+            mean, cov = self.mean, self.cov
+            if mean is None:
+                mean, cov = numpy.zeros(self.d), numpy.zeros((self.d, self.d))
+            self.mean, self.cov = welford_update(mean, cov, self.n_obs, block)
 
+        self.store(block)
+        self.n_obs += len(block)
 
-@jit 
-def update_mean(mean, curr, n_obs):
-    return mean + (curr - mean)/n_obs
 
 @jit
-def update_cov(cov, last, curr, mean, n):
-    lastm = get_mus(last)
-    currm = get_mus(mean)
-    curro = get_mus(curr)
-    f = (n-1)/n
-    return f*(cov + lastm) + (1-f)*curro - currm
\ No newline at end of file
+def welford_update(mean, cov, n, X):
+    ## biased mean and covariance of n earlier points merged with the rows of a (b, d) block X (b=1 for a
+    ## single sample). Deviations D from the old mean give one rank-b update and a rank-1 correction:
+    ## mean' = mean + s and cov' = (n cov + D^T D)/(n+b) - s s^T, with s = sum(D)/(n+b)
+    D = X - mean
+    shift = np.sum(D, axis=0) / (n + X.shape[0])
+    return mean + shift, (n*cov + D.T @ D) / (n + X.shape[0]) - np.outer(shift, shift)
\ No newline at end of file
@@ -0,0 +1,47 @@
+import time
+import numpy as np
+
+from bubblewrap import Bubblewrap
+from benchmark_step import load_data
+
+## Accuracy vs throughput of the active-node mode: every run reports the mean log predictive
+## probability it reaches and its us/step next to the run that scores and updates every node.
+## usage: python scripts/benchmark_active.py [data.npz]
+
+
+def make_bw(data, N, M, active_size, transition_k=None, lazy_decay=False):
+    bw = Bubblewrap(N, data.shape[1], step=8e-2, lam=1e-3, M=M, eps=1e-3, nu=1e-3, B_thresh=-10,
+                    transition_k=transition_k, active_size=active_size, lazy_decay=lazy_decay)
+    for i in np.arange(0, M):
+        bw.observe(data[i])
+    bw.init_nodes()
+    return bw
+
+
+def run(data, N, M, active_size, transition_k=None, lazy_decay=False):
+    ## fit_stream compiles per recording length: the first half warms up, the second half is timed
+    bw = make_bw(data, N, M, active_size, transition_k, lazy_decay)
+    T = (data.shape[0] - M) // 2
+    bw.fit_stream(data[M:M+T])
+    bw.mu.block_until_ready()
+
+    start = time.perf_counter()
+    bw.fit_stream(data[M+T:M+2*T])
+    bw.mu.block_until_ready()
+    us = 1e6 * (time.perf_counter() - start) / T
+
+    return us, float(np.mean(bw.pred[-T:]))
+
+
+if __name__ == '__main__':
+    M = 30
+    for dim in [2, 16]:
+        data = load_data(T=3000, dim=dim)
+        for N, transition_k in [(500, None), (2000, 16)]:
+            us_full, pred_full = run(data, N, M, None, transition_k)
+            print(f'd={dim} N={N} transition_k={transition_k} all nodes: {us_full:.1f} us/step, mean pred {pred_full:.3f}')
+            for active_size in [10, 50, 200]:
+                for lazy_decay in [False, True]:
+                    us, pred = run(data, N, M, active_size, transition_k, lazy_decay)
+                    print(f'd={dim} N={N} transition_k={transition_k} active_size={active_size} lazy_decay={lazy_decay}: '
+                          f'{us:.1f} us/step ({us_full/us:.1f}x), mean pred {pred:.3f} ({pred - pred_full:+.3f})')
@@ -0,0 +1,92 @@
+import sys
+import time
+import jax
+import numpy as np
+
+from bubblewrap import Bubblewrap
+from benchmark_step import load_data
+
+## Speed and error of nearest=k density queries, which score each point against only the k densest tiles
+## the spatial index finds there, next to the exact query over all tiles.
+## With --check it instead verifies, in float64, that the index returns exactly the k densest tiles (of those
+## within 30 nats of the densest), and that nearest=k stays within the error this allows of the exact density,
+## on the data points and on a grid around the data.
+## usage: python scripts/benchmark_index.py [--check] [data.npz]
+
+
+def fit(data, N, M=30, transition_k=None):
+    bw = Bubblewrap(N, data.shape[1], step=8e-2, lam=1e-3, M=M, eps=1e-3, nu=1e-3, B_thresh=-10, transition_k=transition_k)
+    for i in np.arange(0, M):
+        bw.observe(data[i])
+    bw.init_nodes()
+    bw.fit_stream(data[M:])
+    return bw
+
+
+def grid_around(data, n, scale=3, seed=0):
+    ## Gaussian cloud with the mean and covariance of the data, widened by scale
+    rng = np.random.default_rng(seed)
+    return rng.multivariate_normal(data.mean(axis=0), scale**2 * np.cov(data.T), size=n)
+
+
+def check_candidates(bw, X, k, depth=30):
+    ## the tiles the index returns are the k densest among those within depth nats of the densest, over all tiles
+    mu, L, L_diag, n_obs = (np.asarray(a) for a in (bw.mu, bw.L, bw.L_diag, bw.n_obs))
+    log_w = np.log(n_obs + 1e-10) - np.log(np.sum(n_obs + 1e-10))
+    v = np.einsum('mnd,nde->mne', X[:, None] - mu[None], L)
+    joint = log_w + np.sum(L_diag, axis=1) - X.shape[1]/2 * np.log(2*np.pi) - np.sum(v**2, axis=2) / 2
+    joint = np.where(joint >= np.max(joint, axis=1, keepdims=True) - depth, joint, -np.inf)
+    best = np.sort(joint, axis=1)[:, ::-1][:, :k]
+    near = np.sort(bw.build_index().candidates(X, k, depth), axis=1)
+    ## tiles given more than once (the padding) count once
+    found = np.where(np.diff(near, axis=1, prepend=-1) > 0, np.take_along_axis(joint, near, axis=1), -np.inf)
+    found = np.sort(found, axis=1)[:, ::-1][:, :best.shape[1]]
+    both = np.isfinite(best)
+    assert np.array_equal(both, np.isfinite(found)) and np.allclose(found[both], best[both], rtol=0, atol=1e-9)
+
+
+def check_log_density(bw, X, k, name, tol=None):
+    ## the k densest tiles hold at least k/N of the density, and the ones cut at 30 nats below the densest a
+    ## negligible N e^-30 of it, so nearest=k is never more than log(N/k) below the exact density
+    exact = np.asarray(bw.log_density(X))
+    approx = np.asarray(bw.log_density(X, nearest=k))
+    err = exact - approx
+    tol = np.log(bw.N / k) if tol is None else tol
+    assert np.all(err >= -1e-9) and np.max(err) <= tol + 1e-9, (name, k, np.max(err))
+    print(f'{name}: nearest={k} within {np.max(err):.2e} nats of the exact density over {len(X)} points')
+
+
+if __name__ == '__main__':
+    if '--check' in sys.argv:
+        sys.argv.remove('--check')
+        jax.config.update('jax_enable_x64', True)
+        data = load_data(T=400, dim=3)
+        bw = fit(data, N=60)
+        grid = grid_around(data, 2000)
+        for k in [1, 8, 60, 64]:
+            check_candidates(bw, data, k)
+            check_candidates(bw, grid, k)
+        for k in [1, 8]:
+            check_log_density(bw, data, k, 'data points')
+            check_log_density(bw, grid, k, 'grid points')
+        check_log_density(bw, data, 32, 'data points', tol=1e-2)
+        check_log_density(bw, grid, 32, 'grid points', tol=1e-2)
+        sys.exit()
+
+    k = 64
+    for dim in [2, 16]:
+        data = load_data(T=1000, dim=dim)
+        X = np.concatenate([data, grid_around(data, 100000 - len(data))])
+        for N in [2000, 8000]:
+            bw = fit(data, N, transition_k=16)
+            for nearest in [None, k]:
+                bw.log_density(X[:1024], nearest=nearest).block_until_ready()
+            start = time.perf_counter()
+            exact = np.asarray(bw.log_density(X))
+            t_exact = time.perf_counter() - start
+            start = time.perf_counter()
+            approx = np.asarray(bw.log_density(X, nearest=k))
+            t_near = time.perf_counter() - start
+            err = exact - approx
+            print(f'd={dim} N={N}: exact {t_exact:.1f} s, nearest={k} {t_near:.1f} s ({t_exact/t_near:.1f}x), '
+                  f'error 99th percentile {np.percentile(err, 99):.1e}, max {np.max(err):.1e} nats')
@@ -0,0 +1,49 @@
+import time
+import numpy as np
+
+from bubblewrap import Bubblewrap
+from benchmark_step import load_data
+
+## Time to reach a given log predictive probability with the Adam M-step and the closed-form one.
+## A level counts as reached once the mean pred over the last `window` steps gets there.
+## usage: python scripts/benchmark_mstep.py [data.npz]
+
+
+def make_bw(data, N, M, m_step):
+    bw = Bubblewrap(N, data.shape[1], step=8e-2, lam=1e-3, M=M, eps=1e-3, nu=1e-3, B_thresh=-10, m_step=m_step)
+    for i in np.arange(0, M):
+        bw.observe(data[i])
+    bw.init_nodes()
+    return bw
+
+
+def run(data, N, M, m_step):
+    ## the first call compiles fit_stream for this recording length, the second one is timed
+    make_bw(data, N, M, m_step).fit_stream(data[M:])
+
+    bw = make_bw(data, N, M, m_step)
+    start = time.perf_counter()
+    _, pred, _, _ = bw.fit_stream(data[M:])
+    pred = np.asarray(pred)
+    us = 1e6 * (time.perf_counter() - start) / pred.shape[0]
+    return us, pred
+
+
+if __name__ == '__main__':
+    data = load_data(T=6000)
+    M = 30
+    N = 200
+    window = 200
+    levels = [-6, -4, -2, 0]
+
+    for m_step in ['adam', 'closed_form']:
+        us, pred = run(data, N, M, m_step)
+        running = np.convolve(pred, np.ones(window) / window, mode='valid')
+        print(f'{m_step}: {us:.1f} us/step, mean pred over the last {window} steps {running[-1]:.3f}')
+        for level in levels:
+            reached = np.nonzero(running >= level)[0]
+            if len(reached):
+                steps = reached[0] + window
+                print(f'  pred >= {level}: after {steps} samples, {steps * us * 1e-3:.1f} ms')
+            else:
+                print(f'  pred >= {level}: not reached')
@@ -0,0 +1,49 @@
+import time
+import numpy as np
+
+from bubblewrap import Bubblewrap
+from benchmark_step import load_data
+
+## Prediction latency vs fit quality of the M-step schedule: for every m_step_every k, and with the
+## M-step in a background learner thread, the per-step latency (mean, median, p99) of bw.step and
+## the mean log predictive probability.
+## usage: python scripts/benchmark_schedule.py [data.npz]
+
+
+def make_bw(data, N, M, k):
+    bw = Bubblewrap(N, data.shape[1], step=8e-2, lam=1e-3, M=M, eps=1e-3, nu=1e-3, B_thresh=-10, m_step_every=k)
+    for i in np.arange(0, M):
+        bw.observe(data[i])
+    bw.init_nodes()
+    return bw
+
+
+def run(data, N, M, k, learner=False, warmup=100):
+    bw = make_bw(data, N, M, k)
+    if learner:
+        bw.start_learner()
+    latency = []
+    for i in np.arange(M, data.shape[0] - 1):
+        start = time.perf_counter()
+        bw.step(data[i], future_x=data[i+1])
+        bw.mu.block_until_ready()
+        latency.append(time.perf_counter() - start)
+    if learner:
+        bw.stop_learner()
+    latency = 1e6 * np.array(latency[warmup:])
+    return latency, float(np.mean(bw.pred[warmup:]))
+
+
+if __name__ == '__main__':
+    data = load_data(T=3000)
+    M = 30
+    N = 1000
+
+    for k in [1, 2, 5, 10, 20, 50]:
+        latency, pred = run(data, N, M, k)
+        print(f'm_step_every={k}: mean {np.mean(latency):.1f} us/step, p50 {np.percentile(latency, 50):.1f} us, '
+              f'p99 {np.percentile(latency, 99):.1f} us, mean pred {pred:.3f}')
+
+    latency, pred = run(data, N, M, 1, learner=True)
+    print(f'background learner: mean {np.mean(latency):.1f} us/step, p50 {np.percentile(latency, 50):.1f} us, '
+          f'p99 {np.percentile(latency, 99):.1f} us, mean pred {pred:.3f}')
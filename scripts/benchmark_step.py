@@ -0,0 +1,133 @@
+import sys
+import time
+import jax
+import numpy as np
+
+from bubblewrap import Bubblewrap, BubblewrapState
+from datagen import gen_data_diffeq, vdp, random_proj
+
+## Compares per-sample latency of the separate observe/e_step/grad_Q calls
+## against the single fused Bubblewrap.step dispatch.
+## With --check it instead verifies, in float64, that fit_stream replays the same online recursion as both,
+## and that (1, d) sample slices fit exactly like (d,) rows.
+## usage: python scripts/benchmark_step.py [--check] [data.npz]
+
+
+def load_data(T=2000, dim=2):
+    if len(sys.argv) > 1:
+        return np.load(sys.argv[1])['y'][0][:T]
+    _, _, y = gen_data_diffeq(vdp, random_proj, t=(0, 0.05*T + 10), x0=np.array([0.1, 0.1]), dim=dim,
+                              noise='normal', ivp_kwargs={'max_step': 0.05}, noise_kwargs={'loc': 0, 'scale': 0.05})
+    return y[:T]
+
+
+def make_bw(data, N, M, go_fast):
+    bw = Bubblewrap(N, data.shape[1], step=8e-2, lam=1e-3, M=M, eps=1e-3, nu=1e-3, B_thresh=-10, go_fast=go_fast)
+    for i in np.arange(0, M):
+        bw.observe(data[i])
+    bw.init_nodes()
+    return bw
+
+
+def run(bw, data, M, fused, warmup=50):
+    for i in np.arange(M, M + warmup):
+        advance(bw, data, i, fused)
+    bw.mu.block_until_ready()
+
+    start = time.perf_counter()
+    for i in np.arange(M + warmup, data.shape[0] - 1):
+        advance(bw, data, i, fused)
+    bw.mu.block_until_ready()
+    return 1e6 * (time.perf_counter() - start) / (data.shape[0] - 1 - M - warmup)
+
+
+def advance(bw, data, i, fused):
+    if fused:
+        bw.step(data[i], future_x=data[i+1])
+    else:
+        bw.observe(data[i], future_x=data[i+1])
+        bw.e_step()
+        bw.grad_Q()
+
+
+def max_rel_diff(a, b, names=('mu', 'L', 'A', 'alpha', 'n_obs')):
+    diff = {}
+    for k in names:
+        x, y = np.asarray(getattr(a, k)), np.asarray(getattr(b, k))
+        diff[k] = float(np.max(np.abs(x - y)) / (np.max(np.abs(x)) + 1e-12))
+    return diff
+
+
+def check_fit_stream(data, N=100, M=30, T=370, tol=1e-9):
+    ## fit_stream over T samples against the observe/e_step/grad_Q loop and step on the same samples: the same
+    ## state and dead-node queue up to rounding, and (state, pred, pred_far, entropy) stacked over the T steps.
+    ## Run with jax_enable_x64, so float32 rounding doesn't grow into real differences.
+    separate = make_bw(data, N, M, go_fast=False)
+    fused = make_bw(data, N, M, go_fast=False)
+    stream = make_bw(data, N, M, go_fast=False)
+    for i in np.arange(M, M + T):
+        advance(separate, data, i, fused=False)
+        advance(fused, data, i, fused=True)
+    out = stream.fit_stream(data[M:M+T])
+
+    assert isinstance(out, tuple) and len(out) == 4, 'fit_stream returns (state, pred, pred_far, entropy)'
+    state, pred, pred_far, entropy = out
+    assert isinstance(state, BubblewrapState)
+    assert all(np.shape(a) == (T,) for a in (pred, pred_far, entropy)), [np.shape(a) for a in (pred, pred_far, entropy)]
+
+    for name, other in [('observe/e_step/grad_Q', separate), ('step', fused)]:
+        diff = max_rel_diff(other, stream)
+        diff['pred'] = float(np.max(np.abs(np.asarray(other.pred) - np.asarray(pred))) / np.max(np.abs(pred)))
+        print(f'fit_stream vs {name}: max relative difference after {T} samples:', diff)
+        assert max(diff.values()) < tol, diff
+        assert np.array_equal(np.asarray(other.dead_order), np.asarray(stream.dead_order)), 'dead-node queues differ'
+    print('fit_stream matches the online path')
+
+
+def check_driver_loop(data, N=100, M=30, T=200):
+    ## run_bubblewrap.py passes each sample as a (1, d) slice, data[i:i+step] with step=1; observe/e_step/grad_Q
+    ## and step must treat it exactly like the (d,) row
+    rows = make_bw(data, N, M, go_fast=False)
+    sliced = Bubblewrap(N, data.shape[1], step=8e-2, lam=1e-3, M=M, eps=1e-3, nu=1e-3, B_thresh=-10)
+    for i in np.arange(0, M):
+        sliced.observe(data[i:i+1])
+    sliced.init_nodes()
+    for i in np.arange(M, M + T):
+        advance(rows, data, i, fused=i % 2)
+        if i % 2:
+            sliced.step(data[i:i+1], future_x=data[i+1])
+        else:
+            sliced.observe(data[i:i+1], future_x=data[i+1])
+            sliced.e_step()
+            sliced.grad_Q()
+    diff = max_rel_diff(rows, sliced)
+    assert max(diff.values()) == 0 and np.array_equal(np.asarray(rows.pred), np.asarray(sliced.pred)), diff
+    print(f'(1, d) samples match (d,) samples over {T} steps')
+
+
+if __name__ == '__main__':
+    if '--check' in sys.argv:
+        sys.argv.remove('--check')
+        jax.config.update('jax_enable_x64', True)
+        data = load_data()
+        check_fit_stream(data)
+        check_driver_loop(data)
+        sys.exit()
+
+    data = load_data()
+    M = 30
+
+    for N in [100, 1000]:
+        ## Agreement over a short run; float32 rounding differences grow chaotically over long ones.
+        ## Both paths draw the prior drift noise from the model's PRNG key, so they see identical inputs.
+        separate = make_bw(data, N, M, go_fast=False)
+        fused = make_bw(data, N, M, go_fast=False)
+        for i in np.arange(M, M + 200):
+            advance(separate, data, i, fused=False)
+            advance(fused, data, i, fused=True)
+        print(f'N={N} max relative difference after 200 steps:', max_rel_diff(separate, fused))
+
+        for go_fast in [True, False]:
+            t_sep = run(make_bw(data, N, M, go_fast), data, M, fused=False)
+            t_fused = run(make_bw(data, N, M, go_fast), data, M, fused=True)
+            print(f'N={N} go_fast={go_fast}: separate {t_sep:.1f} us/step, fused {t_fused:.1f} us/step ({t_sep/t_fused:.1f}x)')
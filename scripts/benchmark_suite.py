@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import platform
+import itertools
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datagen import gen_data_diffeq, vdp, lorenz, random_proj, random_rotation
+
+## Throughput and latency scaling of Bubblewrap.step over a grid of number of nodes N, dimension d,
+## batch_size and go_fast, on the Van der Pol and Lorenz systems of datagen.py projected to d dimensions
+## and on a synthetic d-dimensional linear stream. Every configuration runs in a fresh process, so its
+## compile time and peak memory are its own, and reports:
+##   compile_s       first call of step (trace + compile + run) minus a steady-state call
+##   steps_per_s     steady-state calls of step per second (samples_per_s counts the rows of a batch)
+##   p50_us, p99_us  latency of one step call, waited for with block_until_ready
+##   peak_rss_mb     peak resident memory of the process; peak_device_mb where the backend reports it
+## One JSON object per configuration goes to --out (JSON lines). With --compare old.jsonl, configurations
+## whose steps_per_s dropped or p99_us grew by more than --tolerance are listed as regressions.
+## usage: python scripts/benchmark_suite.py [--grid quick|full] [--out bench.jsonl] [--compare old.jsonl]
+
+GRIDS = {
+    'quick': dict(system=['vdp', 'lorenz', 'linear'], N=[100, 1000], d=[2, 16], batch_size=[1, 10], go_fast=[True, False]),
+    'full': dict(system=['vdp', 'lorenz', 'linear'], N=[100, 1000, 10000], d=[2, 8, 16, 64], batch_size=[1, 10, 100],
+                 go_fast=[True, False]),
+}
+
+
+def make_data(system, T, dim, seed=0):
+    ## (T, dim) observations of a low-dimensional system, or of a dim-dimensional linear one
+    if system == 'vdp':
+        _, _, y = gen_data_diffeq(vdp, random_proj, t=(0, 0.05*T + 10), x0=np.array([0.1, 0.1]), dim=dim,
+                                  noise='normal', ivp_kwargs={'max_step': 0.05}, noise_kwargs={'loc': 0, 'scale': 0.05})
+    elif system == 'lorenz':
+        _, _, y = gen_data_diffeq(lorenz, random_proj, t=(0, 0.01*T + 10), x0=np.array([0, 1, 1.05]), dim=dim,
+                                  noise='normal', ivp_kwargs={'max_step': 0.01}, noise_kwargs={'loc': 0, 'scale': 0.05})
+    elif system == 'linear':
+        ## slowly rotating plane inside a dim-dimensional space, with isotropic noise in every direction
+        rand = np.random.default_rng(seed)
+        R = random_rotation(2, max(dim, 2), 0.05, seed=seed)[:dim, :dim]
+        y = np.zeros((T, dim))
+        y[0] = rand.normal(size=dim)
+        for t in range(1, T):
+            y[t] = 0.999 * R @ y[t-1] + 0.05 * rand.normal(size=dim)
+    else:
+        raise ValueError(f'unknown system {system}')
+    return np.asarray(y[:T], dtype=float)
+
+
+def run_config(system, N, d, batch_size, go_fast, steps=300, warmup=20, transition_k=None):
+    import jax
+    from bubblewrap import Bubblewrap
+
+    b = batch_size
+    M = max(30, b)
+    data = make_data(system, M + b*(warmup + 2*steps + 2), d)
+    batch = b > 1
+    bw = Bubblewrap(N, d, step=8e-2, lam=1e-3, M=M, eps=1e-3, nu=1e-3, B_thresh=-10, go_fast=go_fast,
+                    batch=batch, batch_size=b, transition_k=transition_k)
+    if batch:
+        bw.observe(data[:M])
+    else:
+        for i in range(M):
+            bw.observe(data[i])
+    bw.init_nodes()
+    bw.sync()
+
+    def advance(i):
+        ## i-th call of step after initialization
+        start = M + i*b
+        if batch:
+            bw.step(data[start:start+b])
+        else:
+            bw.step(data[start], future_x=data[start+1])
+
+    start = time.perf_counter()
+    advance(0)
+    bw.sync()
+    first = time.perf_counter() - start
+    for i in range(1, warmup):
+        advance(i)
+    bw.sync()
+
+    ## throughput: dispatch back to back and wait once, as a stream would run
+    start = time.perf_counter()
+    for i in range(warmup, warmup + steps):
+        advance(i)
+    bw.sync()
+    per_step = (time.perf_counter() - start) / steps
+
+    ## latency: every call waited for on its own
+    latency = []
+    for i in range(warmup + steps, warmup + 2*steps):
+        start = time.perf_counter()
+        advance(i)
+        bw.sync()
+        latency.append(time.perf_counter() - start)
+    latency = 1e6 * np.array(latency)
+
+    stats = jax.devices()[0].memory_stats() or {}
+    return {
+        'compile_s': max(first - per_step, 0.0),
+        'steps_per_s': 1 / per_step,
+        'samples_per_s': b / per_step,
+        'p50_us': float(np.percentile(latency, 50)),
+        'p99_us': float(np.percentile(latency, 99)),
+        'mean_pred': float(np.mean(bw.pred[-steps:])) if not go_fast else None,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_device_mb': stats['peak_bytes_in_use'] / 2**20 if 'peak_bytes_in_use' in stats else None,
+    }
+
+
+def environment():
+    import jax
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit, 'jax': jax.__version__, 'backend': jax.default_backend(), 'python': platform.python_version(),
+            'machine': platform.machine()}
+
+
+def config_key(result):
+    return tuple(result[k] for k in ['system', 'N', 'd', 'batch_size', 'go_fast', 'transition_k'])
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {config_key(r): r for r in map(json.loads, f) if 'error' not in r}
+    regressions = 0
+    for r in results:
+        old = baseline.get(config_key(r))
+        if old is None or 'error' in r:
+            continue
+        slower = old['steps_per_s'] / r['steps_per_s'] - 1
+        later = r['p99_us'] / old['p99_us'] - 1
+        if slower > tolerance or later > tolerance:
+            regressions += 1
+            print(f'REGRESSION {config_key(r)}: steps/s {old["steps_per_s"]:.0f} -> {r["steps_per_s"]:.0f}, '
+                  f'p99 {old["p99_us"]:.0f} -> {r["p99_us"]:.0f} us')
+    print(f'{regressions} regressions against {baseline_path}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--grid', default='quick', choices=GRIDS)
+    parser.add_argument('--system', nargs='*')
+    parser.add_argument('--N', nargs='*', type=int)
+    parser.add_argument('--d', nargs='*', type=int)
+    parser.add_argument('--batch_size', nargs='*', type=int)
+    parser.add_argument('--go_fast', nargs='*', type=lambda s: s.lower() in ('1', 'true'))
+    parser.add_argument('--transition_k', type=int, help='top-k transitions, e.g. for N in the thousands')
+    parser.add_argument('--steps', type=int, default=300)
+    parser.add_argument('--out', default='bench.jsonl')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--one', help=argparse.SUPPRESS)   # JSON configuration, run in this process
+    args = parser.parse_args()
+
+    if args.one:
+        print(json.dumps(run_config(**json.loads(args.one))))
+        sys.exit()
+
+    grid = dict(GRIDS[args.grid])
+    for k in grid:
+        if getattr(args, k):
+            grid[k] = getattr(args, k)
+
+    env = environment()
+    results = []
+    with open(args.out, 'w') as f:
+        for values in itertools.product(*grid.values()):
+            config = dict(zip(grid, values), transition_k=args.transition_k, steps=args.steps)
+            proc = subprocess.run([sys.executable, __file__, '--one', json.dumps(config)], capture_output=True, text=True)
+            result = dict(config, **env)
+            if proc.returncode == 0:
+                result.update(json.loads(proc.stdout.strip().splitlines()[-1]))
+                print(f"{config_key(result)}: compile {result['compile_s']:.2f} s, {result['steps_per_s']:.0f} steps/s, "
+                      f"p99 {result['p99_us']:.0f} us, peak {result['peak_rss_mb']:.0f} MB")
+            else:
+                result['error'] = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f'exit {proc.returncode}'
+                print(f"{config_key(result)}: failed, {result['error']}")
+            results.append(result)
+            f.write(json.dumps(result) + '\n')
+            f.flush()
+
+    if args.compare:
+        compare(results, args.compare, args.tolerance)
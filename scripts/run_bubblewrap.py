@@ -36,6 +36,7 @@ batch = False       # run in batch mode
 batch_size = 1      # batch mode size; if not batch is 1
 go_fast = False     # flag to skip computing priors, predictions, and entropy for optimal speed
 future_distance = 1
+offline = False     # replay the whole recording in one compiled scan (not in batch mode)
 
 bw = Bubblewrap(N, d, step=step, lam=lam, M=M, eps=eps, nu=nu, B_thresh=B_thresh, batch=batch, batch_size=batch_size, go_fast=go_fast, future_distance=future_distance)
 
@@ -54,13 +55,16 @@ bw.init_nodes()
 print('Nodes initialized')
 
 ## Run online, 1 data or batch at a time
-for i in np.arange(init, end, step):
-    future_index = i+M+step - 2 + bw.future_distance
-    future_x = data[future_index] if future_index < ((end- 1) + M + step ) else None
-
-    bw.observe(data[i+M:i+M+step], future_x=future_x)
-    bw.e_step()  
-    bw.grad_Q()
+if offline:
+    bw.fit_stream(data)
+else:
+    for i in np.arange(init, end, step):
+        future_index = i+M+step - 2 + bw.future_distance
+        future_x = data[future_index] if future_index < ((end- 1) + M + step ) else None
+
+        bw.observe(data[i+M:i+M+step], future_x=future_x)
+        bw.e_step()  
+        bw.grad_Q()
 print('Done fitting all data online')
 
 ## Plotting
@@ -86,4 +90,6 @@ if saving:
     L = np.save('saved_L.npy', bw.L)
     n_obs = np.save('saved_n_obs.npy', bw.n_obs)
     pred = np.save('saved_pred.npy', bw.pred)
-    entropy = np.save('saved_entropy.npy', bw.entropy_list)
\ No newline at end of file
+    entropy = np.save('saved_entropy.npy', bw.entropy_list)
+    ## the whole model, to continue with bw = Bubblewrap.load_state('bubblewrap_state.bw')
+    bw.save_state('bubblewrap_state.bw')